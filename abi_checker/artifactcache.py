@@ -0,0 +1,104 @@
+from functools import partial
+from pathlib import Path
+import tempfile
+import asyncio
+import shutil
+import time
+
+from .util import touch
+
+
+class ArtifactCache:
+    """Content-addressed directory of build artifacts
+
+    Each entry is a directory named by a key (a digest of everything that
+    went into it). The produced files are written to a temporary directory
+    which is renamed into place once complete, so a present entry is always
+    usable. Concurrent requests for the same key share a single task.
+
+    If the producing process was killed by a signal (e.g. for running out
+    of memory), the entry isn't stored under its key: it's kept as
+    .KEY.unstored for the callers that are waiting for it, and produced
+    again when it's requested later. (Timeouts raise from `produce`, so
+    they're not stored either.)
+
+    With reuse_existing=False, entries made before this ArtifactCache was
+    created are produced again (and replaced).
+    """
+
+    def __init__(self, path, *, reuse_existing=True):
+        self.path = path
+        self.reuse_existing = reuse_existing
+        self._created = time.time()
+        self._tasks = {}
+
+    async def get(self, key, produce):
+        """Get (entry_path, returncode) for key
+
+        If the entry is missing, ``await produce(tmpdir)`` should fill
+        tmpdir and return the producing process's return code.
+        """
+        try:
+            task = self._tasks[key]
+        except KeyError:
+            task = asyncio.create_task(
+                self._get(key, produce),
+                name=f'artifact {key}',
+            )
+            self._tasks[key] = task
+            task.add_done_callback(partial(self._forget, key))
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        # Later requests look at the disk again (and touch the entry)
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+    async def _get(self, key, produce):
+        entry = self.path / key
+        returncode = _read_returncode(entry, since=(
+            None if self.reuse_existing else self._created
+        ))
+        if returncode is not None:
+            touch(entry)
+            return entry, returncode
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmpdir = Path(tempfile.mkdtemp(dir=self.path, prefix=f'.{key}-'))
+        try:
+            returncode = await produce(tmpdir)
+            (tmpdir / 'returncode').write_text(f'{returncode}\n')
+            if returncode < 0:
+                entry = self.path / f'.{key}.unstored'
+                self._remove(entry)
+            elif not self.reuse_existing:
+                self._remove(entry)
+            try:
+                tmpdir.rename(entry)
+            except OSError:
+                # Another process got there first; its entry is equivalent
+                pass
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        return entry, _read_returncode(entry)
+
+    def _remove(self, entry):
+        # Move the entry aside first, so it's never seen half-deleted
+        old = Path(tempfile.mkdtemp(dir=self.path, prefix=f'.{entry.name}-'))
+        try:
+            entry.rename(old / entry.name)
+        except FileNotFoundError:
+            pass
+        finally:
+            shutil.rmtree(old, ignore_errors=True)
+
+
+def _read_returncode(entry, since=None):
+    """Read an entry's return code; None if it's missing or older than
+    `since` (a timestamp)"""
+    path = entry / 'returncode'
+    try:
+        if since is not None and path.stat().st_mtime < since:
+            return None
+        return int(path.read_text())
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,393 @@
+"""Benchmark of the orchestration code, with a fake CPython repository
+
+    python -m abi_checker.benchmark --builds 4,8,16 --cases 10,20
+
+This generates a git repository (using git fast-import) with many version
+tags, whose configure, make, python and C compiler are quick shell stubs,
+and synthetic cases. Nearly all the time is then spent in abi_checker
+itself.
+
+For each matrix size, a child process computes all results with an empty
+cache ("cold"; the stub processes still run), then again from the stored
+results ("warm"), and renders the report for the terminal and (if Quart
+is installed) the web. Reported are the wall times, time to the first
+result, event loop lag, rendering latency and the child's peak RSS.
+"""
+
+from pathlib import Path
+import collections
+import contextlib
+import subprocess
+import statistics
+import argparse
+import tempfile
+import asyncio
+import shutil
+import time
+import json
+import sys
+import os
+
+from .root import Root
+from .report import Report
+from .commit import CPythonCommit
+from . import process
+
+STUB_CONFIGURE = r'''#!/bin/sh
+# Stub configure: no checks, just the Makefile
+srcdir=$(cd "$(dirname "$0")" && pwd)
+echo "checking whether this is a stub... yes"
+sed "s|@srcdir@|$srcdir|g" "$srcdir/Makefile.pre.in" > Makefile
+'''
+
+STUB_MAKEFILE = '''srcdir=@srcdir@
+all:
+\tsed "s|%srcdir%|$(srcdir)|g" $(srcdir)/Tools/stub/sysconfig.json > sysconfig.json
+\tcp $(srcdir)/Tools/stub/python python
+\tcp $(srcdir)/Tools/stub/python-config.py python-config.py
+pythoninfo:
+\t./python -c pythoninfo
+'''
+
+STUB_PYTHON = r'''#!/bin/sh
+# Stub interpreter: answers the sysconfig probe, and "runs" scripts
+# (they fail if they contain EXIT_FAILURE)
+if [ "$1" = -c ]; then
+    exec cat "$(dirname "$0")/sysconfig.json"
+fi
+if grep -q EXIT_FAILURE "$1"; then
+    exit 1
+fi
+'''
+
+STUB_CC = r'''#!/bin/sh
+# Stub C compiler: writes a placeholder output file
+while [ $# -gt 0 ]; do
+    if [ "$1" = -o ]; then
+        shift
+        echo stub > "$1"
+    fi
+    shift
+done
+'''
+
+CASE_EXTENSION = '''#include <Python.h>
+
+/* synthetic case {index} */
+static struct PyModuleDef module = {{
+    PyModuleDef_HEAD_INIT, "extension", NULL, 0, NULL,
+}};
+
+PyMODINIT_FUNC
+PyInit_extension(void)
+{{
+    return PyModuleDef_Init(&module);
+}}
+'''
+
+CASE_EXPECTED = '''if exec_version < v(3, {minor}):
+    raise ExpectFailure('needs 3.{minor}')
+'''
+
+
+def make_fake_repo(path, n_tags):
+    """Create a fake CPython repository with n_tags version tags
+
+    Tags are v3.9.0, v3.10.0, ... v3.14.0, v3.9.1, ...; each is a commit
+    that changes only the version.
+    """
+    files = {
+        'configure': (STUB_CONFIGURE, '100755'),
+        'Makefile.pre.in': (STUB_MAKEFILE, '100644'),
+        'Tools/stub/python': (STUB_PYTHON, '100755'),
+        'Tools/stub/cc': (STUB_CC, '100755'),
+        'Tools/stub/python-config.py': ('', '100644'),
+        'Include/Python.h': ('/* stub */\n', '100644'),
+        'Lib/os.py': ('# stub\n', '100644'),
+    }
+    commands = []
+    def data(content):
+        content = content.encode()
+        commands.append(b'data %d\n%s\n' % (len(content), content))
+    marks = {}
+    for mark, (name, (content, mode)) in enumerate(files.items(), start=1):
+        commands.append(b'blob\nmark :%d\n' % mark)
+        data(content)
+        marks[name] = mark, mode
+    tags = []
+    for i in range(n_tags):
+        minor = 9 + i % 6
+        micro = i // 6
+        version = f'3.{minor}.{micro}'
+        hexversion = (3 << 24) | (minor << 16) | (micro << 8) | 0xf0
+        sysconfig = json.dumps({
+            'config_vars': {
+                'CC': '%srcdir%/Tools/stub/cc',
+                'Py_ENABLE_SHARED': 0,
+            },
+            'pyconfig_flags': '-I%srcdir%/Include',
+            'hexversion': hexversion,
+            'abiflags': '',
+            'soabi': 'stub',
+        })
+        commands.append(b'commit refs/heads/main\n')
+        commands.append(b'committer Stub <stub@example.org> %d +0000\n' % i)
+        data(f'Python {version}')
+        if i == 0:
+            for name, (mark, mode) in marks.items():
+                commands.append(f'M {mode} :{mark} {name}\n'.encode())
+        commands.append(b'M 100644 inline README.rst\n')
+        data(f'This is Python version {version}\n')
+        commands.append(b'M 100644 inline Tools/stub/sysconfig.json\n')
+        data(sysconfig)
+        commands.append(b'M 100644 inline Include/patchlevel.h\n')
+        data(f'#define PY_VERSION "{version}"\n')
+        commands.append(f'reset refs/tags/v{version}\n'.encode())
+        commands.append(b'from refs/heads/main\n\n')
+        tags.append(f'v{version}')
+    subprocess.run(['git', 'init', '-q', path], check=True)
+    subprocess.run(
+        ['git', 'fast-import', '--quiet'],
+        input=b''.join(commands), cwd=path, check=True,
+    )
+    return tags
+
+
+def make_cases(path, n_cases):
+    """Create n_cases synthetic cases in path
+
+    Every 7th case's script fails; expected.py files need various exec
+    versions.
+    """
+    path.mkdir(parents=True)
+    for i in range(n_cases):
+        case_dir = path / f'case-{i:04}'
+        case_dir.mkdir()
+        (case_dir / 'extension.c').write_text(CASE_EXTENSION.format(index=i))
+        (case_dir / 'script.py').write_text(
+            'import extension\n'
+            + ('raise SystemExit("EXIT_FAILURE")\n' if i % 7 == 6 else '')
+        )
+        (case_dir / 'expected.py').write_text(
+            CASE_EXPECTED.format(minor=9 + i % 6),
+        )
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a sleeping task"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lags.append(time.monotonic() - start - self.interval)
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._task.cancel()
+
+    def summarize(self):
+        if not self.lags:
+            return {'max': 0, 'p99': 0, 'mean': 0}
+        lags = sorted(self.lags)
+        return {
+            'max': lags[-1],
+            'p99': lags[int(len(lags) * .99)],
+            'mean': statistics.fmean(lags),
+        }
+
+
+async def compute_all(report):
+    """Get all results of a report; return timings"""
+    start = time.monotonic()
+    first = None
+    results = collections.Counter()
+    def on_result(index, result):
+        nonlocal first
+        results[result.name] += 1
+        if first is None:
+            first = time.monotonic() - start
+    await report.compute_cells(on_result=on_result)
+    return {
+        'cells': len(await report.get_matrix()),
+        'wall_time': time.monotonic() - start,
+        'first_result': first,
+        'results': results,
+    }
+
+
+async def time_rendering(root, report):
+    """Time rendering the report for the CLI and, if possible, the web"""
+    from .cli import write_report
+    start = time.monotonic()
+    await write_report(report)
+    result = {'cli_render': time.monotonic() - start, 'web_render': None}
+    # The app makes its own Root from the environment on import;
+    # it's replaced by ours
+    os.environ.setdefault('CPYTHON_DIR', str(root.cpython_dir))
+    try:
+        from . import quart_app
+    except ImportError:
+        return result
+    quart_app.root = root
+    quart_app.report = report
+    async with quart_app.app.test_app() as test_app:
+        client = test_app.test_client()
+        start = time.monotonic()
+        response = await client.get('/')
+        await response.get_data()
+        result['web_render'] = time.monotonic() - start
+    return result
+
+
+async def run_step(params):
+    """Compute & render one matrix size (in a child process)"""
+    result = {}
+    for phase in 'cold', 'warm':
+        root = Root(
+            cpython_dir=Path(params['repo']),
+            cache_dir=Path(params['cache_dir']),
+            case_dir=Path(params['case_dir']),
+            jobs=params['jobs'],
+        )
+        try:
+            tags = params['tags']
+            commits = [CPythonCommit(root, tag) for tag in tags]
+            report = Report(root, commits=commits)
+            async with LoopLagMonitor() as monitor:
+                result[phase] = await compute_all(report)
+            result[phase]['loop_lag'] = monitor.summarize()
+            if phase == 'warm':
+                result.update(await time_rendering(root, report))
+        finally:
+            await root.aclose()
+    return result
+
+
+def pick_tags(tags, n):
+    """Pick n tags spread evenly over the list"""
+    n = min(n, len(tags))
+    return [tags[i * len(tags) // n] for i in range(n)]
+
+
+def _ms(seconds):
+    return '-' if seconds is None else f'{seconds * 1000:.0f}'
+
+
+async def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0])
+    parser.add_argument(
+        '--tags', type=int, default=300,
+        help='Number of version tags in the fake repository.')
+    parser.add_argument(
+        '--builds', default='2,4,8',
+        help='Comma-separated numbers of commits to build (each step '
+            + 'of the benchmark uses one of these).')
+    parser.add_argument(
+        '--cases', default='10,20',
+        help='Comma-separated numbers of cases.')
+    parser.add_argument(
+        '-j', '--jobs', type=int,
+        help='Number of CPUs to use (default: all).')
+    parser.add_argument(
+        '--workdir', type=Path,
+        help='Directory for the fake repository & caches '
+            + '(default: a temporary one, removed afterwards).')
+    parser.add_argument(
+        '--json', metavar='PATH', type=Path,
+        help='Also write the results to PATH as JSON.')
+    parser.add_argument('--step', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv[1:])
+
+    if args.step:
+        # Child process: the orchestration code prints a lot
+        out = sys.stdout
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull):
+                result = await run_step(json.loads(args.step))
+        print(json.dumps(result), file=out)
+        return
+
+    if args.workdir:
+        workdir = args.workdir.resolve()
+        workdir.mkdir(parents=True, exist_ok=True)
+    else:
+        workdir = Path(tempfile.mkdtemp(prefix='abi_checker-benchmark-'))
+    try:
+        await run_steps(args, workdir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+async def run_steps(args, workdir):
+    repo = workdir / 'cpython'
+    if not repo.exists():
+        make_fake_repo(repo, args.tags)
+    tags = subprocess.run(
+        ['git', 'tag', '--list', '--sort=version:refname'],
+        cwd=repo, check=True, capture_output=True, text=True,
+    ).stdout.split()
+    print(f'{"builds":>6}{"cases":>7}{"cells":>8}{"cold s":>8}{"warm s":>8}'
+          + f'{"1st ms":>8}{"lag ms":>8}{"CLI ms":>8}{"web ms":>8}'
+          + f'{"RSS MB":>8}{"errors":>8}')
+    results = []
+    for n_cases in (int(n) for n in args.cases.split(',')):
+        case_dir = workdir / f'cases-{n_cases}'
+        if not case_dir.exists():
+            make_cases(case_dir, n_cases)
+        for n_builds in (int(n) for n in args.builds.split(',')):
+            cache_dir = workdir / f'cache-{n_builds}-{n_cases}'
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            params = dict(
+                repo=str(repo),
+                case_dir=str(case_dir),
+                cache_dir=str(cache_dir),
+                tags=pick_tags(tags, n_builds),
+                jobs=args.jobs,
+            )
+            proc = await process.run(
+                [
+                    sys.executable, '-m', 'abi_checker.benchmark',
+                    '--step', json.dumps(params),
+                ],
+                stdout=subprocess.PIPE,
+            )
+            if proc.returncode != 0:
+                raise RuntimeError(f'benchmark step failed: {params}')
+            result = json.loads(proc.stdout_data)
+            result.update(
+                builds=n_builds,
+                cases=n_cases,
+                max_rss=proc.rusage.ru_maxrss * 1024,
+            )
+            results.append(result)
+            print(
+                f'{n_builds:>6}{n_cases:>7}{result["cold"]["cells"]:>8}'
+                + f'{result["cold"]["wall_time"]:>8.2f}'
+                + f'{result["warm"]["wall_time"]:>8.2f}'
+                + f'{_ms(result["cold"]["first_result"]):>8}'
+                + f'{_ms(result["warm"]["loop_lag"]["max"]):>8}'
+                + f'{_ms(result["cli_render"]):>8}'
+                + f'{_ms(result["web_render"]):>8}'
+                + f'{result["max_rss"] / 2**20:>8.0f}'
+                + f'{result["cold"]["results"].get("ERROR", 0):>8}',
+                flush=True,
+            )
+            shutil.rmtree(cache_dir, ignore_errors=True)
+    print('(1st: time to the first cold result; lag: worst event loop '
+          + 'lag while computing warm results; errors: cells with the '
+          + 'error result, which mean the benchmark itself is broken)')
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=1))
+
+
+if __name__ == '__main__':
+    exit(asyncio.run(main(sys.argv)))
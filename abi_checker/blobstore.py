@@ -0,0 +1,164 @@
+import subprocess
+import os
+
+# Only files in these directories are shared between worktrees.
+# They're what built interpreters and extensions need (see
+# CPythonCommit.drop_sources), and builds don't write to them.
+SHARED_DIRS = 'Include/', 'Lib/'
+
+# Shared files get this fixed, old mtime, so it doesn't matter which
+# worktree added them to the store (and make never finds them newer
+# than what's built from them)
+SHARED_MTIME = 946684800  # 2000-01-01
+
+# Git file modes of shared files, and the permissions they get
+SHARED_MODES = {
+    '100644': 0o444,
+    '100755': 0o555,
+}
+
+
+class BlobStore:
+    """Files shared between worktrees, stored once per content
+
+    Shared files of worktrees are hard links to files in the store, named
+    by their git blob ID and mode. They're made read-only, so a process
+    that writes to one in place fails rather than changing all worktrees
+    that share it.
+
+    Files that no worktree links to anymore (st_nlink == 1) are removed
+    by `prune` (see cachegc).
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.path = root.cache_dir / 'blobs'
+
+    def get_path(self, oid, mode):
+        return self.path / oid[:2] / f'{oid}-{mode}'
+
+    async def check_out(
+        self, repo_dir, worktree, index_path, commit_hash, *,
+        shared_dirs=SHARED_DIRS,
+    ):
+        """Check out the files of an index that are missing in worktree
+
+        The index should be that of commit_hash.
+        Files in shared_dirs (a subset of SHARED_DIRS) are linked from
+        the store if they're there, and added to it if not.
+        Returns the number of files that were linked from the store.
+        """
+        env = {**os.environ, 'GIT_INDEX_FILE': str(index_path)}
+        proc = await self.root.run_process(
+            'git', '--git-dir', repo_dir, 'ls-files', '--stage', '-z',
+            stdout=subprocess.PIPE,
+            env=env,
+        )
+        to_check_out = []
+        oids = set()
+        to_add = []
+        linked = 0
+        for line in proc.stdout_data.decode().split('\0'):
+            if not line:
+                continue
+            info, tab, path = line.partition('\t')
+            mode, oid, stage = info.split()
+            dest = worktree / path
+            if os.path.lexists(dest):
+                continue
+            if mode in SHARED_MODES and path.startswith(tuple(shared_dirs)):
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                try:
+                    os.link(self.get_path(oid, mode), dest)
+                except FileNotFoundError:
+                    to_add.append((dest, oid, mode))
+                else:
+                    linked += 1
+                    continue
+            to_check_out.append(path)
+            oids.add(oid)
+        if to_check_out:
+            await self._prefetch(repo_dir, commit_hash, oids)
+            await self.root.run_process(
+                'git', '--git-dir', repo_dir, '--work-tree', worktree,
+                'checkout-index', '-z', '--stdin',
+                input=''.join(p + '\0' for p in to_check_out).encode(),
+                env=env,
+            )
+        for dest, oid, mode in to_add:
+            self._add(dest, oid, mode)
+        self.root.counters['worktree files shared'] += linked
+        self.root.counters['worktree files checked out'] += len(to_check_out)
+        return linked
+
+    async def _prefetch(self, repo_dir, commit_hash, oids):
+        """Fetch the blobs among oids that repo_dir (a partial clone)
+        doesn't have yet, in one batch
+
+        checkout-index would fetch each one on its own.
+        """
+        proc = await self.root.run_process(
+            'git', '--git-dir', repo_dir,
+            'rev-list', '--objects', '--missing=print', '--no-object-names',
+            commit_hash,
+            stdout=subprocess.PIPE,
+        )
+        missing = [
+            line[1:] for line in proc.stdout_data.decode().splitlines()
+            if line.startswith('?') and line[1:] in oids
+        ]
+        if missing:
+            # What git does for a lazy fetch, with all the objects at once
+            await self.root.run_process(
+                'git', '--git-dir', repo_dir,
+                '-c', 'fetch.negotiationAlgorithm=noop',
+                'fetch', 'origin', '--no-tags', '--no-write-fetch-head',
+                '--recurse-submodules=no', '--filter=blob:none', '--stdin',
+                input=''.join(oid + '\n' for oid in missing).encode(),
+            )
+
+    def _add(self, path, oid, mode):
+        """Put a checked-out file in the store, or link it to a copy
+        that's already there"""
+        os.chmod(path, SHARED_MODES[mode])
+        os.utime(path, (SHARED_MTIME, SHARED_MTIME))
+        blob_path = self.get_path(oid, mode)
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(path, blob_path)
+        except FileExistsError:
+            # Added by someone else in the meantime
+            tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+            os.link(blob_path, tmp)
+            os.replace(tmp, path)
+
+
+def break_link(path):
+    """Replace a shared file with a private, writable copy
+
+    The copy gets the current time as mtime.
+    """
+    st = os.lstat(path)
+    if st.st_nlink <= 1:
+        return
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    with open(path, 'rb') as src, open(tmp, 'xb') as dst:
+        while chunk := src.read(1 << 20):
+            dst.write(chunk)
+    os.chmod(tmp, st.st_mode & 0o777 | 0o200)
+    os.replace(tmp, path)
+
+
+def prune(path):
+    """Remove blobs no worktree links to; return (count, size)"""
+    count = size = 0
+    for blob_path in path.glob('*/*'):
+        try:
+            st = blob_path.lstat()
+        except FileNotFoundError:
+            continue
+        if st.st_nlink == 1:
+            blob_path.unlink(missing_ok=True)
+            count += 1
+            size += st.st_blocks * 512
+    return count, size
@@ -1,14 +1,40 @@
 import collections
 import subprocess
 import asyncio
+import shutil
 import shlex
+import json
 import os
 
-from .util import cached_task
-from .errors import SkipBuild
-from .commit import CPythonCommit
+from .util import cached_task, touch
+from .errors import SkipBuild, ExecServerDied
+from .commit import CPythonCommit, find_build_dirs
+from .execserver import ExecServer
 from .pyversion import PyVersion
 from .compileoptions import CompileOptions
+from .buildcache import count_configure_checks, get_make_cc, ccache_env
+from .elf import get_dynamic_symbols
+
+# Run with a freshly built interpreter to record everything we need to know
+# about the build. Must work on all tested versions (3.5+).
+SYSCONFIG_PROBE = '''
+import json, subprocess, sys, sysconfig
+pyconfig_flags = subprocess.check_output(
+    [sys.executable, sys.argv[1], '--cflags', '--ldflags'],
+    universal_newlines=True,
+)
+json.dump(
+    {
+        'config_vars': sysconfig.get_config_vars(),
+        'pyconfig_flags': pyconfig_flags.strip(),
+        'hexversion': sys.hexversion,
+        'abiflags': getattr(sys, 'abiflags', ''),
+        'soabi': sysconfig.get_config_var('SOABI'),
+    },
+    sys.stdout,
+    default=str,
+)
+'''
 
 
 class Build:
@@ -38,33 +64,92 @@ class Build:
     async def run_python(self, *args, **kwargs):
         executable = await self.get_executable()
         return await self.root.run_process(
-            executable, *args, **kwargs,
+            executable, *args, build=self, **kwargs,
+        )
+
+    async def run_script(
+        self, script, *, cwd, stdout, stderr, env, timeout=None, rlimits=None,
+        case=None,
+    ):
+        """Run a Python script, possibly forked from a warm exec server
+
+        If the server died, the script is run in a new process.
+        """
+        server = await self.get_exec_server()
+        if server is not None and server.alive:
+            try:
+                return await server.run_script(
+                    script,
+                    cwd=cwd, stdout=stdout, stderr=stderr, env=env,
+                    timeout=timeout, rlimits=rlimits, case=case,
+                )
+            except ExecServerDied:
+                pass
+        return await self.run_python(
+            script,
+            cwd=cwd, stdout=stdout, stderr=stderr, env=env,
+            check=False,
+            stage='exec',
+            case=case,
+            timeout=timeout,
+            rlimits=rlimits,
         )
 
+    @cached_task
+    async def get_exec_server(self):
+        if self.root.exec_engine != 'fork':
+            return None
+        if not all(feature.fork_safe for feature in self.features):
+            return None
+        server = ExecServer(self.root, self, await self.get_executable())
+        await server.start()
+        self.root.exit_stack.push_async_callback(server.aclose)
+        return server
+
+    async def is_built(self):
+        """True if the interpreter was built (this doesn't build it)"""
+        build_dir = await self.get_build_dir()
+        return (build_dir / 'python').exists()
+
     @cached_task
     async def get_executable(self):
         build_dir = await self.get_build_dir()
         executable = build_dir / 'python'
         if executable.exists():
+            touch(build_dir)
             return executable
+        async with self.commit.using_sources():
+            await self._make(build_dir, executable)
+        if self.root.drop_worktree_sources:
+            await self.commit.drop_sources()
+        return executable
+
+    async def _make(self, build_dir, executable):
         await self.configure()
         try:
             async with self.lock:
                 if executable.exists():
-                    return executable
+                    return
                 await self.root.run_process(
                     'make',
-                    '-j', str(os.process_cpu_count() or 2),
+                    *(await self._get_ccache_args()),
                     stdout=build_dir / 'make.log',
                     stderr=build_dir / 'make.log',
                     cwd=build_dir,
+                    make=True,
+                    stage='make',
+                    build=self,
                 )
-                version = await self._get_version(executable)
+                info = await self._probe_sysconfig(executable)
+                version = PyVersion.from_hex(info['hexversion'])
                 if version > PyVersion.pack(3, 7):
                     await self.root.run_process(
                         'make', 'pythoninfo',
                         stdout=build_dir / 'pythoninfo',
                         cwd=build_dir,
+                        make=True,
+                        stage='make',
+                        build=self,
                     )
                 commit_version = await self.commit.get_version()
                 def vkey(version):
@@ -75,7 +160,6 @@ class Build:
         except:
             executable.unlink(missing_ok=True)
             raise
-        return executable
 
     @cached_task
     async def configure(self):
@@ -89,49 +173,156 @@ class Build:
         async with self.lock:
             if makefile_path.exists():
                 return
+            if self.root.seed_builds and not build_dir.exists():
+                await self._seed_build_dir(build_dir)
             build_dir.mkdir(exist_ok=True)
             config_options = []
             for feature in self.features:
                 config_options.extend(feature.config_options)
+            if self.root.config_cache:
+                config_cache = self.root.get_config_cache(
+                    self.features, worktree / 'configure',
+                )
+                config_cache.copy_to(build_dir / 'config.cache')
+                config_options.append('--cache-file=config.cache')
             await self.root.run_process(
                 worktree / 'configure',
                 *config_options,
                 stdout=await self.get_config_log_path(),
                 stderr=await self.get_config_log_path(),
                 cwd=build_dir,
+                stage='configure',
+                build=self,
             )
+            if self.root.config_cache:
+                await config_cache.merge_from(build_dir / 'config.cache')
+                cached, total = count_configure_checks(
+                    await self.get_config_log_path(),
+                )
+                self.root.counters['config.cache hits'] += cached
+                self.root.counters['config.cache misses'] += total - cached
+
+    async def _get_ccache_args(self):
+        """Arguments for make to compile through ccache, if enabled"""
+        if not self.root.ccache:
+            return []
+        if not shutil.which('ccache'):
+            print('ccache not found; not using it')
+            return []
+        await self.root.get_ccache_baseline()
+        build_dir = await self.get_build_dir()
+        cc = get_make_cc(build_dir / 'Makefile')
+        return [
+            f'CC=ccache {cc}',
+            *(f'{name}={value}' for name, value in ccache_env(self.root).items()),
+        ]
+
+    async def _seed_build_dir(self, build_dir):
+        """Fill build_dir with a copy of a similar build, if there is one
+
+        configure then retargets the copy at our worktree, and make only
+        rebuilds what changed (see CPythonCommit.get_seed_commit).
+        """
+        seed_commit = await self.commit.get_seed_commit()
+        if seed_commit is None:
+            return
+        seed_hash = await seed_commit.get_commit_hash()
+        feature_tags = ''.join(f.tag for f in self.features)
+        for chash, features, seed_dir in find_build_dirs(self.root):
+            if chash == seed_hash and features == feature_tags:
+                break
+        else:
+            return
+        tmp_dir = build_dir.with_name(f'.{build_dir.name}.seeding')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        await self.root.run_process(
+            'cp', '-a', '--reflink=auto', seed_dir, tmp_dir,
+            stage='configure',
+            build=self,
+        )
+        # Remove what must be regenerated for the new source tree:
+        # the interpreter (so make runs and the version gets checked),
+        # the Makefile (so configure runs), sysconfig data (which records
+        # the source directory), logs, and our own records of the build.
+        for name in (
+            'python', 'Makefile', 'pybuilddir.txt',
+            '_config.log', 'make.log', 'pythoninfo',
+            'abi_checker_sysconfig.json', 'python.symbols.json',
+        ):
+            (tmp_dir / name).unlink(missing_ok=True)
+        for pattern in '_sysconfigdata*', '_sysconfig_vars*':
+            for path in tmp_dir.glob(f'build/*/{pattern}'):
+                path.unlink()
+        for path in tmp_dir.glob('abi_checker_layout-*'):
+            path.unlink()
+        (tmp_dir / '_seed').write_text(f'{seed_dir.name}\n')
+        await self.commit.touch_changed_since_seed(
+            await asyncio.to_thread(_get_newest_mtime, tmp_dir),
+        )
+        tmp_dir.rename(build_dir)
 
     @cached_task
-    async def get_build_dir(self):
+    async def get_identity(self):
         chash = await self.commit.get_commit_hash()
-        return self.root.cache_dir / f'build-{self.tag}-{chash}'
+        return f'{self.tag}-{chash}'
+
+    @cached_task
+    async def get_build_dir(self):
+        return self.root.cache_dir / f'build-{await self.get_identity()}'
 
     @cached_task
     async def get_config_log_path(self):
         build_dir = await self.get_build_dir()
         return build_dir / '_config.log'
 
-    async def get_config_var(self, var):
-        proc = await self.run_python(
-            '-c',
-            f'import sysconfig; print(sysconfig.get_config_var({var!r}))',
-            stdout=subprocess.PIPE,
-        )
-        return proc.stdout_data.decode().strip()
+    @cached_task
+    async def get_sysconfig(self):
+        """Get the build's sysconfig snapshot (see SYSCONFIG_PROBE)
+
+        It is recorded in the build directory right after make.
+        """
+        executable = await self.get_executable()
+        try:
+            return json.loads(
+                (await self.get_sysconfig_path()).read_text(),
+            )
+        except FileNotFoundError:
+            return await self._probe_sysconfig(executable)
 
-    async def run_pyconfig(self, *args):
+    @cached_task
+    async def get_sysconfig_path(self):
         build_dir = await self.get_build_dir()
-        proc = await self.run_python(
+        return build_dir / 'abi_checker_sysconfig.json'
+
+    async def _probe_sysconfig(self, executable):
+        build_dir = await self.get_build_dir()
+        proc = await self.root.run_process(
+            executable,
+            '-c', SYSCONFIG_PROBE,
             build_dir / 'python-config.py',
-            *args,
             stdout=subprocess.PIPE,
+            stage='make',
+            build=self,
         )
-        return proc.stdout_data.decode().strip()
+        info = json.loads(proc.stdout_data)
+        path = await self.get_sysconfig_path()
+        tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+        tmp.write_bytes(proc.stdout_data)
+        os.replace(tmp, path)
+        return info
+
+    async def get_config_var(self, var):
+        """Get a sysconfig variable as a string (None gives 'None')
+
+        This is what printing sysconfig.get_config_var(var) in the build
+        would give.
+        """
+        return str((await self.get_sysconfig())['config_vars'].get(var))
 
     @cached_task
     async def get_flags(self):
         return tuple(shlex.split(
-            await self.run_pyconfig('--cflags', '--ldflags'),
+            (await self.get_sysconfig())['pyconfig_flags'],
         ))
 
     @cached_task
@@ -140,17 +331,26 @@ class Build:
 
     @cached_task
     async def get_version(self):
-        executable = await self.get_executable()
-        return await self._get_version(executable)
+        return PyVersion.from_hex((await self.get_sysconfig())['hexversion'])
 
-    async def _get_version(self, executable):
-        proc = await self.root.run_process(
-            executable,
-            '-c',
-            f'import sys; print(sys.hexversion)',
-            stdout=subprocess.PIPE,
-        )
-        return PyVersion.from_hex(int(proc.stdout_data.decode()))
+    @cached_task
+    async def get_exported_symbols(self):
+        """Names of dynamic symbols extensions can use; None if unknown
+
+        These come from the executable, and libpython if it's shared.
+        """
+        executable = await self.get_executable()
+        paths = [executable]
+        if await self.get_config_var('Py_ENABLE_SHARED') == '1':
+            library = await self.get_config_var('LDLIBRARY')
+            paths.append(executable.parent / library)
+        exported = set()
+        for path in paths:
+            symbols = get_dynamic_symbols(path)
+            if symbols is None:
+                return None
+            exported.update(symbols.defined)
+        return frozenset(exported)
 
     @cached_task
     async def get_possible_compile_options(self):
@@ -172,3 +372,14 @@ class Build:
             else:
                 result.append(opts)
         return result
+
+
+def _get_newest_mtime(path):
+    """Get the newest mtime of anything under path"""
+    newest = os.lstat(path).st_mtime
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            newest = max(
+                newest, os.lstat(os.path.join(dirpath, name)).st_mtime,
+            )
+    return newest
@@ -0,0 +1,109 @@
+import subprocess
+import asyncio
+import shutil
+import os
+import re
+
+
+class ConfigCache:
+    """A config.cache shared by configure runs with the same compiler,
+    features & configure script
+
+    Each configure run gets a private copy (configure rewrites its cache
+    file wholesale, so concurrent runs can't share one), and new results
+    are merged back afterwards.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = asyncio.Lock()
+
+    def copy_to(self, dest):
+        try:
+            shutil.copyfile(self.path, dest)
+        except FileNotFoundError:
+            pass
+
+    async def merge_from(self, src):
+        try:
+            new = _parse_config_cache(src.read_text())
+        except FileNotFoundError:
+            return
+        async with self.lock:
+            try:
+                entries = _parse_config_cache(self.path.read_text())
+            except FileNotFoundError:
+                entries = {}
+            entries.update(new)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(f'.{self.path.name}.{os.getpid()}.tmp')
+            tmp.write_text(''.join(entries.values()))
+            os.replace(tmp, self.path)
+
+
+def _parse_config_cache(text):
+    """Parse cache lines (`ac_cv_foo=${ac_cv_foo=value}`) into a dict
+
+    "Precious" variables (ac_cv_env_*) are skipped: they record the
+    environment of one particular run, and configure refuses to run if
+    they don't match.
+    """
+    entries = {}
+    for line in text.splitlines(keepends=True):
+        name, sep, rest = line.partition('=')
+        if sep and name.isidentifier() and not name.startswith('ac_cv_env_'):
+            entries[name] = line
+    return entries
+
+
+def count_configure_checks(log_path):
+    """Return (cached, total) counts of `checking ...` lines in a configure log
+    """
+    cached = total = 0
+    try:
+        with open(log_path, errors='replace') as f:
+            for line in f:
+                if line.startswith('checking '):
+                    total += 1
+                    if '(cached)' in line:
+                        cached += 1
+    except FileNotFoundError:
+        pass
+    return cached, total
+
+
+def get_make_cc(makefile_path):
+    """Get the value of CC from a generated Makefile"""
+    match = re.search(
+        r'^CC=[ \t]*(.*?)[ \t]*$', makefile_path.read_text(), re.MULTILINE,
+    )
+    return match[1]
+
+
+def ccache_env(root):
+    return {
+        'CCACHE_DIR': str(root.cache_dir / 'ccache'),
+        'CCACHE_BASEDIR': str(root.cache_dir),
+        'CCACHE_NOHASHDIR': '1',
+    }
+
+
+async def get_ccache_stats(root):
+    """Get ccache's counters as a dict, or None if unavailable"""
+    if not shutil.which('ccache'):
+        return None
+    proc = await root.run_process(
+        'ccache', '--print-stats',
+        env={**os.environ, **ccache_env(root)},
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+    if proc.returncode != 0:
+        return None
+    stats = {}
+    for line in proc.stdout_data.decode().splitlines():
+        name, sep, value = line.partition('\t')
+        if sep and value.strip().isdigit():
+            stats[name] = int(value)
+    return stats
@@ -0,0 +1,325 @@
+"""Removing least recently used entries from the cache directory
+
+The cache is made of entries that are removed as a whole:
+
+- a commit: its worktree (cpython_HASH, with marker & lock files) with all
+  builds of it (build-TAG-HASH); builds need their worktree's headers
+- the run directories of a case & compile build (runs/CASE/BUILD)
+- the packed logs of a build (logs/TAG.pack & .idx; see LogStore)
+- entries of the compiled module & exec caches (modules/KEY, execs/KEY)
+
+An entry's last use is the newest mtime of anything in it; code that
+reuses an entry touches it (see util.touch).
+
+Entries are never removed if they were used recently, or if they belong
+to a commit the report uses. Other commits, runs of builds or cases that
+are gone, and cache entries that no run links to are unreferenced.
+Without a budget, all unreferenced entries are removed; with a budget,
+entries are removed in order of last use (unreferenced ones first) only
+until the cache fits.
+In the process that serves the report, referenced entries are never
+removed: the report holds on to them (e.g. finished compiles of its runs)
+regardless of when they were last touched.
+
+Afterwards, files of the BlobStore that no worktree links to are removed.
+"""
+
+from pathlib import Path
+import dataclasses
+import argparse
+import asyncio
+import shutil
+import stat
+import time
+import os
+
+from .util import parse_size
+from . import blobstore
+
+# Entries used less than this many seconds ago are kept, since another
+# process might be using them
+KEEP_RECENT = 3600
+
+
+@dataclasses.dataclass
+class CacheEntry:
+    kind: str
+    name: str
+    paths: list
+    referenced: bool = False
+    size: int = 0
+    last_used: float = 0
+
+    def __str__(self):
+        return f'{self.kind} {self.name}'
+
+
+@dataclasses.dataclass
+class CollectResult:
+    removed: list
+    size_before: int
+    size_after: int
+    dry_run: bool = False
+
+    @property
+    def reclaimed(self):
+        return self.size_before - self.size_after
+
+    def __str__(self):
+        if self.dry_run:
+            return (
+                f'gc: would remove {len(self.removed)} entries, '
+                + f'about {format_size(self.reclaimed)}'
+            )
+        return (
+            f'gc: removed {len(self.removed)} entries, '
+            + f'reclaimed {format_size(self.reclaimed)}; '
+            + f'cache is now {format_size(self.size_after)}'
+        )
+
+
+async def collect(
+    report, *, budget=None, keep_recent=KEEP_RECENT, dry_run=False,
+    live=False,
+):
+    """Remove cache entries; return a CollectResult
+
+    `report` gives the commits, builds and cases that are in use.
+    Set `live` if the report is in use in this process; then only
+    unreferenced entries are removed, even with a budget.
+    """
+    root = report.root
+    commit_hashes = set()
+    build_tags = set()
+    for build in await report.get_builds():
+        commit_hashes.add(await build.commit.get_commit_hash())
+        build_tags.add(build.tag)
+    case_tags = {case.tag for case in await report.get_cases()}
+    return await asyncio.to_thread(
+        _collect, root.cache_dir,
+        commit_hashes=commit_hashes, build_tags=build_tags,
+        case_tags=case_tags, budget=budget, keep_recent=keep_recent,
+        dry_run=dry_run, keep_referenced=live,
+    )
+
+
+def _collect(
+    cache_dir, *, commit_hashes, build_tags, case_tags, budget, keep_recent,
+    dry_run, keep_referenced=False,
+):
+    entries = scan(cache_dir)
+    for entry in entries:
+        measure(entry)
+    size_before = get_size(cache_dir)
+    for entry in entries:
+        if entry.kind == 'commit':
+            entry.referenced = entry.name in commit_hashes
+        elif entry.kind == 'runs':
+            case_tag, build_tag = entry.name.split('/')
+            entry.referenced = case_tag in case_tags and build_tag in build_tags
+        elif entry.kind == 'logs':
+            entry.referenced = entry.name in build_tags
+    now = time.time()
+    candidates = sorted(
+        (
+            e for e in entries
+            if not e.referenced or (e.kind != 'commit' and not keep_referenced)
+            if now - e.last_used >= keep_recent
+        ),
+        key=lambda e: (e.referenced, e.last_used),
+    )
+    removed = []
+    size = size_before
+    for entry in candidates:
+        if budget is None:
+            if entry.referenced:
+                break
+        elif size <= budget:
+            break
+        print(
+            'gc:', 'would remove' if dry_run else 'removing', entry,
+            f'({format_size(entry.size)},',
+            f'last used {time.ctime(entry.last_used)})',
+        )
+        if not dry_run:
+            for path in entry.paths:
+                remove(path)
+        removed.append(entry)
+        size -= entry.size
+    if not dry_run:
+        count, blob_size = blobstore.prune(cache_dir / 'blobs')
+        if count:
+            print(
+                f'gc: removed {count} unused blobs',
+                f'({format_size(blob_size)})',
+            )
+        size = get_size(cache_dir)
+    result = CollectResult(removed, size_before, size, dry_run)
+    if budget is not None and size > budget:
+        print(
+            f'gc: cache is still over budget ({format_size(budget)});',
+            'the rest is in use',
+        )
+    return result
+
+
+def scan(cache_dir):
+    """List the CacheEntries in cache_dir (without sizes)"""
+    commits = {}
+    def add_to_commit(commit_hash, path):
+        commits.setdefault(
+            commit_hash, CacheEntry('commit', commit_hash, []),
+        ).paths.append(path)
+    for path in cache_dir.glob('cpython_*'):
+        commit_hash = path.name.removeprefix('cpython_').partition('.')[0]
+        add_to_commit(commit_hash, path)
+    for path in cache_dir.glob('build-*-*'):
+        tag, sep, commit_hash = path.name.rpartition('-')
+        add_to_commit(commit_hash, path)
+    entries = [e for e in commits.values() if len(e.name) == 40]
+    for path in sorted(cache_dir.glob('runs/*/*')):
+        if not path.name.startswith('.') and path.is_dir():
+            name = f'{path.parent.name}/{path.name}'
+            entries.append(CacheEntry('runs', name, [path]))
+    for path in sorted(cache_dir.glob('logs/*.pack')):
+        entries.append(CacheEntry(
+            'logs', path.stem, [path, path.with_suffix('.idx')],
+        ))
+    for kind in 'modules', 'execs':
+        for path in sorted(cache_dir.glob(f'{kind}/*')):
+            # Unstored entries (see ArtifactCache) are removed like others
+            if not path.name.startswith('.') or path.suffix == '.unstored':
+                entries.append(CacheEntry(kind, path.name, [path]))
+    return entries
+
+
+def measure(entry):
+    """Fill in an entry's size, last use and (for cache entries) whether
+    any run links to it
+
+    The size of a hard-linked file is split between its links; it's only
+    freed when all of them are removed.
+    """
+    entry.size = 0
+    entry.last_used = 0
+    linked = False
+    for path in entry.paths:
+        for st in _walk_stat(path):
+            entry.last_used = max(entry.last_used, st.st_mtime)
+            if stat.S_ISDIR(st.st_mode):
+                entry.size += st.st_blocks * 512
+            else:
+                linked = linked or st.st_nlink > 1
+                entry.size += st.st_blocks * 512 // st.st_nlink
+    if entry.kind in ('modules', 'execs'):
+        entry.referenced = linked
+
+
+def get_size(path):
+    """Disk space used by everything under path"""
+    seen_inodes = set()
+    size = 0
+    for st in _walk_stat(path):
+        key = st.st_dev, st.st_ino
+        if key not in seen_inodes:
+            seen_inodes.add(key)
+            size += st.st_blocks * 512
+    return size
+
+
+def _walk_stat(path):
+    """Yield lstat results of path and everything under it"""
+    try:
+        yield os.lstat(path)
+    except FileNotFoundError:
+        return
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            try:
+                yield os.lstat(os.path.join(dirpath, name))
+            except FileNotFoundError:
+                pass
+
+
+def remove(path):
+    """Remove a file or directory tree
+
+    Directories are renamed aside first, so they're never seen
+    half-deleted.
+    """
+    if path.is_dir() and not path.is_symlink():
+        doomed = path.with_name(f'.{path.name}.{os.getpid()}.gc')
+        try:
+            path.rename(doomed)
+        except FileNotFoundError:
+            return
+        shutil.rmtree(doomed, ignore_errors=True)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def format_size(size):
+    for unit in 'B', 'KB', 'MB', 'GB':
+        if abs(size) < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'TB'
+    return f'{size:.0f}{unit}' if unit == 'B' else f'{size:.1f}{unit}'
+
+
+async def main(argv):
+    from .root import Root
+    from .report import Report
+
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description='Remove unused entries from the cache directory.',
+    )
+    parser.add_argument(
+        'cpython_dir', metavar='CPYTHON_DIR',
+        help='directory with CPython source checkout; its commits that '
+            + 'the report uses are kept')
+    parser.add_argument(
+        '--cache_dir',
+        type=Path,
+        default=Path('.cache'),
+        help='Cache directory.')
+    parser.add_argument(
+        '--case_dir',
+        type=Path,
+        default=Path(__file__, '../cases'),
+        help='Directory of cases.')
+    parser.add_argument(
+        '--cache-budget',
+        metavar='SIZE',
+        type=parse_size,
+        help='Remove least recently used entries (including runs and '
+            + 'compiled modules of current builds) until the cache fits '
+            + 'in SIZE. Without this, all unreferenced entries are removed.')
+    parser.add_argument(
+        '--keep-recent',
+        metavar='SECONDS',
+        type=float,
+        default=KEEP_RECENT,
+        help='Keep entries used this recently (default: %(default)s).')
+    parser.add_argument(
+        '-n', '--dry-run',
+        action='store_true',
+        help="Only print what would be removed.")
+    args = parser.parse_args(argv[1:])
+    root = Root(
+        cpython_dir=Path(args.cpython_dir).resolve(),
+        cache_dir=Path(args.cache_dir).resolve(),
+        case_dir=Path(args.case_dir).resolve(),
+    )
+    try:
+        result = await collect(
+            Report(root),
+            budget=args.cache_budget,
+            keep_recent=args.keep_recent,
+            dry_run=args.dry_run,
+        )
+        print(result)
+    finally:
+        await root.aclose()
@@ -1,11 +1,13 @@
 from functools import cached_property
 from pathlib import Path
 import dataclasses
+import hashlib
 import asyncio
 import tomllib
 
 from .root import Root
 from .build import Build
+from .errors import ExpectFailure
 from .pyversion import PyVersion
 
 
@@ -40,6 +42,7 @@ class Case:
     def __init__(self, root, path):
         self.root = root
         self.path = path
+        self._expected_failures = {}
 
     def __str__(self):
         return self.name
@@ -60,6 +63,31 @@ class Case:
     def tag(self):
         return self.path.name
 
+    @cached_property
+    def digest(self):
+        """Hash of all input files of the case (sources, headers, scripts)"""
+        hasher = hashlib.sha256()
+        for path in sorted(self.path.rglob('*')):
+            if path.is_file() and '__pycache__' not in path.parts:
+                hasher.update(str(path.relative_to(self.path)).encode() + b'\0')
+                hasher.update(path.read_bytes() + b'\0')
+        return hasher.hexdigest()
+
+    @cached_property
+    def config(self):
+        """Contents of the optional case.toml"""
+        try:
+            with open(self.path / 'case.toml', 'rb') as f:
+                return tomllib.load(f)
+        except FileNotFoundError:
+            return {}
+
+    @cached_property
+    def timeouts(self):
+        """Per-stage timeouts (seconds) from the [timeouts] table of case.toml
+        """
+        return self.config.get('timeouts', {})
+
     @cached_property
     def compatibility_script(self):
         path = self.path / 'expected.py'
@@ -68,3 +96,44 @@ class Case:
         except FileNotFoundError:
             return compile('', '<empty>', 'exec')
         return compile(content, str(path), 'exec')
+
+    def get_expected_failure(
+        self, compile_version, exec_version, compile_features, exec_features,
+        is_limited_api, limited_api,
+    ):
+        """Run expected.py; return the ExpectFailure it raises, or None
+
+        The script only sees the arguments, so its outcome is memoized
+        on them.
+        """
+        key = (
+            compile_version, exec_version,
+            tuple(compile_features), tuple(exec_features),
+            is_limited_api, limited_api,
+        )
+        try:
+            failure = self._expected_failures[key]
+        except KeyError:
+            try:
+                exec(self.compatibility_script, dict(
+                    compile_version=compile_version,
+                    exec_version=exec_version,
+                    compile_features=list(compile_features),
+                    exec_features=list(exec_features),
+                    is_limited_api=is_limited_api,
+                    limited_api=limited_api,
+                    v=PyVersion.pack,
+                    ExpectFailure=ExpectFailure,
+                ))
+            except ExpectFailure as e:
+                failure = e
+            else:
+                failure = None
+            self._expected_failures[key] = failure
+        if failure is None:
+            return None
+        # A fresh exception each time, so raising it doesn't add to
+        # a shared traceback
+        return ExpectFailure(*failure.args).with_traceback(
+            failure.__traceback__,
+        )
@@ -1,15 +1,16 @@
 from functools import cached_property
 import dataclasses
 import tempfile
+import hashlib
 import asyncio
 import os
 
-from .util import cached_task
+from .util import cached_task, link_file
 from .build import Build
-from .errors import ExpectFailure, SkipBuild
-from .pyversion import PyVersion
+from .errors import ExpectFailure, SkipBuild, ProcessTimeout
 from .runresult import RunResult
 from .testmodule import TestModule
+from .logstore import get_run_logs
 
 
 @dataclasses.dataclass
@@ -38,7 +39,7 @@ class CaseRun:
         except ExpectFailure as e:
             expect_fail = e
         real_result = await self._get_real_result()
-        if real_result == RunResult.ERROR:
+        if real_result in (RunResult.ERROR, RunResult.TIMEOUT):
             return real_result
         try:
             if expect_fail is not None:
@@ -54,30 +55,171 @@ class CaseRun:
 
     async def _get_real_result(self):
         try:
+            key = await self.get_store_key()
+            if self.root.reuse_results:
+                stored = await self.root.result_store.get(key)
+                if stored is not None:
+                    result, logs = stored
+                    await self._restore_logs(logs)
+                    return result
             result = await self.test_module.get_result()
-            if result != RunResult.SUCCESS:
-                return result
-            proc = await self.exec()
-            if proc.returncode != 0:
-                return RunResult.EXEC_FAILURE
+            if result == RunResult.SUCCESS:
+                missing_symbols = await self.get_missing_symbols()
+                if missing_symbols:
+                    self.root.counters['predicted exec failures'] += 1
+                    if self.root.skip_predicted_failures:
+                        # Not stored: it's not a real result
+                        return RunResult.EXEC_FAILURE
+                returncode = await self.exec()
+                if returncode != 0:
+                    result = RunResult.EXEC_FAILURE
+                elif missing_symbols:
+                    self.root.counters['mispredicted exec failures'] += 1
+        except ProcessTimeout as e:
+            # Not stored: the timeouts may be changed for the next run
+            self.exception = e
+            return RunResult.TIMEOUT
         except Exception as e:
             self.exception = e
             return RunResult.ERROR
-        return RunResult.SUCCESS
+        self.root.result_store.put(
+            key, result, get_run_logs(self.root.log_store, self.tag),
+        )
+        return result
+
+    async def _restore_logs(self, logs):
+        """Put logs of a stored result where get_log finds them
+
+        Logs that are already there are kept.
+        """
+        for name, data in logs.items():
+            if name == 'compile.log':
+                build_tag = self.compile_build.tag
+                key = self.test_module.tag
+                path = self.test_module.path
+            else:
+                build_tag = self.exec_build.tag
+                key = self.tag
+                path = self.path
+            if self.root.log_store.get(build_tag, key, name) is not None:
+                continue
+            if self.root.pack_logs:
+                await self.root.log_store.put(build_tag, key, name, data)
+            else:
+                path.mkdir(parents=True, exist_ok=True)
+                tmp = path / f'.{name}.{os.getpid()}.tmp'
+                tmp.write_bytes(data)
+                os.replace(tmp, path / name)
+
+    @cached_task
+    async def get_store_key(self):
+        return await get_store_key(
+            self.case, self.compile_build, self.compile_options,
+            self.exec_build,
+        )
+
+    @cached_task
+    async def get_missing_symbols(self):
+        """C API symbols the extension needs but the exec build lacks
+
+        If there are any, the extension will fail to load.
+        Returns None if it can't be determined.
+        """
+        imported = await self.test_module.get_imported_symbols()
+        if imported is None:
+            return None
+        exported = await self.exec_build.get_exported_symbols()
+        if exported is None:
+            return None
+        return sorted(
+            name for name in imported
+            if name.startswith(('Py', '_Py')) and name not in exported
+        )
+
+    async def get_known_missing_symbols(self):
+        """Like get_missing_symbols, but only if the builds and the compiled
+        extension are there already (e.g. to show a stored result)
+
+        Returns None rather than building or compiling anything.
+        """
+        if not CaseRun.get_missing_symbols.is_done(self) and not (
+            (self.test_module.path / 'extension.so').exists()
+            and await self.compile_build.is_built()
+            and await self.exec_build.is_built()
+        ):
+            return None
+        return await self.get_missing_symbols()
+
+    @cached_task
+    async def get_exec_key(self):
+        """Digest of the extension's contents, the case and the exec build
+
+        Runs whose extensions came out byte-identical share an exec.
+        """
+        hasher = hashlib.sha256()
+        for part in (
+            await self.test_module.get_extension_digest(),
+            self.case.digest,
+            await self.exec_build.get_identity(),
+        ):
+            hasher.update(str(part).encode() + b'\0')
+        return hasher.hexdigest()
 
     async def exec(self):
-        self.path.mkdir(parents=True, exist_ok=True)
-        build = self.exec_build
-        with tempfile.TemporaryDirectory() as tmpdir:
-            proc = await build.run_python(
-                self.case.py_script_path,
-                cwd=tmpdir,
-                stdout=self.path / 'stdout.log',
-                stderr=self.path / 'stderr.log',
-                env={**os.environ, 'PYTHONPATH': self.test_module.path},
-                check=False,
-            )
-        return proc
+        """Run the case script (or reuse an identical exec); return returncode
+        """
+        produced = False
+        async def produce(tmpdir):
+            nonlocal produced
+            produced = True
+            (tmpdir / 'exec_origin').write_text(f'{self.tag}\n')
+            with tempfile.TemporaryDirectory() as cwd:
+                proc = await self.exec_build.run_script(
+                    self.case.py_script_path,
+                    cwd=cwd,
+                    stdout=tmpdir / 'stdout.log',
+                    stderr=tmpdir / 'stderr.log',
+                    env={**os.environ, 'PYTHONPATH': self.test_module.path},
+                    timeout=self.root.get_timeout('exec', self.case),
+                    rlimits=self.root.exec_rlimits,
+                    case=self.case,
+                )
+            return proc.returncode
+        entry, returncode = await self.root.exec_cache.get(
+            await self.get_exec_key(), produce,
+        )
+        if not produced:
+            self.root.counters['execs deduplicated'] += 1
+        if self.root.pack_logs:
+            for name in 'stdout.log', 'stderr.log', 'exec_origin':
+                await self.root.log_store.put_file(
+                    self.exec_build.tag, self.tag, name, entry / name,
+                )
+        else:
+            self.path.mkdir(parents=True, exist_ok=True)
+            for name in 'stdout.log', 'stderr.log', 'exec_origin':
+                link_file(entry / name, self.path / name)
+        return returncode
+
+    def get_log(self, name):
+        """Get the contents of a log (compile.log, stdout.log, stderr.log)
+
+        Returns None if there's no such log.
+        """
+        if name == 'compile.log':
+            data = self.test_module.get_log(name)
+        else:
+            data = self.root.log_store.get(self.exec_build.tag, self.tag, name)
+        if data is None:
+            return None
+        return data.decode(errors='replace')
+
+    def get_exec_origin(self):
+        """Tag of the run whose exec this run's result came from"""
+        origin = self.get_log('exec_origin')
+        if origin is None:
+            return None
+        return origin.strip()
 
     @cached_property
     def root(self):
@@ -99,9 +241,14 @@ class CaseRun:
     def extension_module_path(self):
         return self.test_module.extension_module_path
 
-    @property
-    def has_result(self):
-        return self.get_result.task.done()
+    @cached_property
+    def tag(self):
+        return '/'.join((
+            self.case.tag,
+            self.compile_build.tag,
+            self.compile_options.tag,
+            self.exec_build.tag,
+        ))
 
     @cached_property
     def path(self):
@@ -116,19 +263,50 @@ class CaseRun:
 
     @cached_task
     async def verify_compatibility(self):
-        exec_version = await self.exec_build.commit.get_version()
-        if self.compile_options.is_limited_api:
-            if self.compile_options.limited_api >= exec_version.hex:
-                raise SkipBuild('limited API larger than exec version')
-        script = self.case.compatibility_script
-        compile_version = await self.compile_build.commit.get_version()
-        exec(script, dict(
-            compile_version=compile_version,
-            exec_version=exec_version,
-            compile_features=[f.tag for f in self.compile_build.features],
-            exec_features=[f.tag for f in self.exec_build.features],
-            is_limited_api=self.compile_options.is_limited_api,
-            limited_api=self.compile_options.limited_api_pyversion,
-            v=PyVersion.pack,
-            ExpectFailure=ExpectFailure,
-        ))
+        exception = get_expectation(
+            self.case,
+            await self.compile_build.commit.get_version(),
+            await self.exec_build.commit.get_version(),
+            [f.tag for f in self.compile_build.features],
+            [f.tag for f in self.exec_build.features],
+            self.compile_options,
+        )
+        if exception is not None:
+            raise exception
+
+
+async def get_store_key(case, compile_build, compile_options, exec_build):
+    """Digest of everything the real (compile+exec) result of a cell
+    depends on
+
+    This doesn't need the builds, so stored results are reused without
+    building CPython. (Compile flags are determined by the commit and
+    features, which are part of the build identities.)
+    """
+    hasher = hashlib.sha256()
+    for part in (
+        case.digest,
+        await compile_build.get_identity(),
+        compile_options.tag,
+        await exec_build.get_identity(),
+    ):
+        hasher.update(str(part).encode() + b'\0')
+    return hasher.hexdigest()
+
+
+def get_expectation(
+    case, compile_version, exec_version, compile_features, exec_features,
+    compile_options,
+):
+    """Get SkipBuild or ExpectFailure for a cell that shouldn't work
+
+    Returns None if the cell is expected to work.
+    This only needs the versions of the commits, not the builds.
+    """
+    if compile_options.is_limited_api:
+        if compile_options.limited_api >= exec_version.hex:
+            return SkipBuild('limited API larger than exec version')
+    return case.get_expected_failure(
+        compile_version, exec_version, compile_features, exec_features,
+        compile_options.is_limited_api, compile_options.limited_api_pyversion,
+    )
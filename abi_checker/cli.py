@@ -6,9 +6,15 @@ import sys
 from .root import Root
 from .report import Report
 from .runresult import RunResult
+from .util import parse_size, parse_timeouts
+from . import cachegc, logstore
 
 
 async def main(argv):
+    if argv[1:2] == ['gc']:
+        return await cachegc.main([f'{argv[0]} gc', *argv[2:]])
+    if argv[1:2] == ['logs']:
+        return await logstore.main([f'{argv[0]} logs', *argv[2:]])
     parser = argparse.ArgumentParser(prog=argv[0])
     parser.add_argument(
         'cpython_dir', metavar='CPYTHON_DIR',
@@ -23,27 +29,136 @@ async def main(argv):
         type=Path,
         default=Path(__file__, '../cases'),
         help='Directory of cases.')
+    parser.add_argument(
+        '--rerun',
+        action='store_true',
+        help='Ignore stored results and run all cases again.')
+    parser.add_argument(
+        '--exec-engine',
+        choices=('spawn', 'fork'),
+        default='spawn',
+        help='How to run case scripts: a new interpreter for each run, '
+            + 'or forked from a warm interpreter per exec build.')
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        help='Number of CPUs to use for all processes, including the '
+            + 'parallel jobs of make (default: all).')
+    parser.add_argument(
+        '--seed-builds',
+        action='store_true',
+        help='Start new CPython builds from a copy of an existing build '
+            + 'of the same minor version, and rebuild only what changed.')
+    parser.add_argument(
+        '--config-cache',
+        action='store_true',
+        help='Share autoconf results between configure runs that use the '
+            + 'same compiler, features and configure script.')
+    parser.add_argument(
+        '--ccache',
+        action='store_true',
+        help='Compile CPython through ccache, with the cache in CACHE_DIR.')
+    parser.add_argument(
+        '--dedup-worktrees',
+        action='store_true',
+        help='Share identical files of the Include & Lib directories '
+            + 'between CPython checkouts, as hard links to a store in '
+            + 'CACHE_DIR.')
+    parser.add_argument(
+        '--drop-worktree-sources',
+        action='store_true',
+        help='After building a commit, remove its checked-out sources '
+            + 'except Include & Lib. They are checked out again if needed.')
+    parser.add_argument(
+        '--pack-logs',
+        action='store_true',
+        help='Keep logs of runs in a few compressed pack files per build '
+            + '(CACHE_DIR/logs), rather than a directory per run. '
+            + 'See them with the `logs` subcommand.')
+    parser.add_argument(
+        '--skip-predicted-failures',
+        action='store_true',
+        help="Don't run extensions that need C API symbols the exec build "
+            + 'lacks; report an exec failure right away.')
+    parser.add_argument(
+        '--timeout',
+        metavar='STAGE=SECONDS[,...]',
+        type=parse_timeouts,
+        action='append',
+        help='Kill processes of a stage (configure, make, compile, exec, '
+            + 'other) that run longer than this. Cases can override these '
+            + 'in the [timeouts] table of case.toml.')
+    parser.add_argument(
+        '--exec-memory-limit',
+        metavar='SIZE',
+        type=parse_size,
+        help='Limit the address space of case scripts (RLIMIT_AS), '
+            + 'e.g. 2G.')
+    parser.add_argument(
+        '--exec-cpu-limit',
+        metavar='SECONDS',
+        type=int,
+        help='Limit the CPU time of case scripts (RLIMIT_CPU).')
+    parser.add_argument(
+        '--memory-budget',
+        metavar='SIZE',
+        type=parse_size,
+        help='Hold back processes (builds, compiles, case scripts) that '
+            + 'could push the memory used by all of them over SIZE, '
+            + 'going by the peak memory seen for each stage '
+            + '(default: the memory available at start).')
+    parser.add_argument(
+        '--trace',
+        metavar='PATH',
+        type=Path,
+        help='Write timings of all processes and tasks to PATH, as JSON '
+            + 'for Perfetto (ui.perfetto.dev) or chrome://tracing.')
+    parser.add_argument(
+        '--cache-budget',
+        metavar='SIZE',
+        type=parse_size,
+        help='After the report, remove least recently used cache entries '
+            + 'until the cache fits in SIZE (see `gc --help`).')
 
     args = parser.parse_args(argv[1:])
     root = Root.from_args(args)
+    root.start_repo_sync()
+    try:
+        report = Report(root)
+        await run_report(report)
+        await write_stats(root)
+        # Don't interrupt a fetch that started in the background
+        await root.get_synced_repo()
+        if root.cache_budget is not None:
+            print(await cachegc.collect(report, budget=root.cache_budget))
+    finally:
+        await root.aclose()
+        print(root.tracer.format_summary())
+        if args.trace:
+            root.tracer.write_chrome_trace(args.trace)
 
-    report = Report(root)
+async def run_report(report):
+    progress_task = asyncio.create_task(write_progress(report.root))
+    try:
+        await _run_report(report)
+    finally:
+        progress_task.cancel()
 
+async def _run_report(report):
+    matrix = await report.get_matrix()
+    exceptions = []
+    def on_result(index, result):
+        # No CaseRun is needed for this (see Report.get_run)
+        case, compile_build, compile_options, exec_build = matrix.get_cell(index)
+        print(
+            f'<CaseRun {case.name} comp={compile_build} exec={exec_build}>',
+            matrix.get(index), matrix.get_message(index),
+        )
+        if result == RunResult.ERROR:
+            exceptions.append(matrix.errors[index])
     async with asyncio.TaskGroup() as tg:
         tg.create_task(write_report(report))
-
-        tasks = []
-        for run in await report.get_runs():
-            async def task(run):
-                return run, await run.get_result()
-            tasks.append(tg.create_task(task(run)))
-
-        exceptions = []
-        async for task in asyncio.as_completed(tasks):
-            run, result = await task
-            print(run, result, run.exception)
-            if result == RunResult.ERROR:
-                exceptions.append(run.exception)
+        await report.compute_cells(on_result=on_result)
         if exceptions:
             raise ExceptionGroup('Runs failed', exceptions)
 
@@ -51,24 +166,40 @@ async def main(argv):
 
     print('ok')
 
+async def write_progress(root, interval=5):
+    while True:
+        await asyncio.sleep(interval)
+        print('queues (running+waiting):', root.scheduler.format_queue_depths())
+
+async def write_stats(root):
+    ccache_stats = await root.get_ccache_delta()
+    if ccache_stats is not None:
+        for name, value in ccache_stats.items():
+            root.counters[f'ccache {name}'] += value
+    for name, value in sorted(root.counters.items()):
+        print(f'{name}: {value}')
+
 async def write_report(report):
-    compile_builds = list(await report.get_compile_builds())
-    build_size = max(len(str(b)) for b in compile_builds)
-    opt_size = max(
-            len(str(comp_opts))
-            for comp_opts in (await report.get_possible_compile_options())
-    )
-    for case in (await report.get_cases()):
+    """Print the result matrix, waiting for missing results"""
+    matrix = await report.get_matrix()
+    if not matrix.rows:
+        return
+    build_size = max(len(str(build)) for build, opts in matrix.rows)
+    opt_size = max(len(str(opts)) for build, opts in matrix.rows)
+    for case in matrix.cases:
         print(case)
-        for compile_build in compile_builds:
+        for compile_build, options in matrix.get_compile_groups():
             build_header = f'{compile_build!s:>{build_size}}'
-            for comp_opts in (await compile_build.get_possible_compile_options()):
+            for comp_opts in options:
                 parts = []
                 parts.append(f'{build_header}:{comp_opts!s:>{opt_size}}:')
-                for exec_build in (await report.get_exec_builds()):
-                    run = report.get_run(
-                        case, compile_build, comp_opts, exec_build)
-                    result = await run.get_result()
+                for exec_build, result, message, expected in matrix.iter_row(
+                    case, compile_build, comp_opts,
+                ):
+                    if result is None:
+                        result = await report.get_result(
+                            case, compile_build, comp_opts, exec_build,
+                        )
                     parts.append(result.emoji)
                 print(''.join(parts))
             build_header = ' ' * len(build_header)
@@ -1,14 +1,24 @@
 from functools import cached_property
+from pathlib import Path
 import dataclasses
+import contextlib
 import subprocess
+import tempfile
 import asyncio
-import re
+import shutil
+import fcntl
+import time
+import os
 
 from .root import Root
-from .util import cached_task
+from .util import cached_task, touch
 from .pyversion import PyVersion
+from .blobstore import SHARED_DIRS, SHARED_MTIME, break_link
 
-readme_re = re.compile(rb"This is Python version (?P<version>[\.\da-z]+)")
+# Timestamp given to sources that are unchanged from a seed commit,
+# so that make considers objects copied from the seed's build up to date.
+# Shared files (see BlobStore) already have it.
+SEED_MTIME = SHARED_MTIME
 
 @dataclasses.dataclass
 class CPythonCommit:
@@ -20,30 +30,243 @@ class CPythonCommit:
 
     @cached_task
     async def get_worktree(self):
+        """Get a checkout of the commit's source tree
+
+        The tree is extracted into a temporary directory using a private
+        index file, then renamed into place, so checkouts take no shared
+        lock in the repository and any number of them can run at once.
+
+        With dedup_worktrees, files in get_shared_dirs() are linked
+        from the BlobStore.
+        The sources may have been dropped (see drop_sources); use
+        `using_sources` to get them back.
+        """
         commit_hash = await self.get_commit_hash()
         worktree_dir = self.root.cache_dir / f'cpython_{commit_hash}'
-        for try_count in range(5):
-            if worktree_dir.exists():
-                return worktree_dir
-            proc = await self.root.run_process(
-                'git', 'worktree', 'add',
-                '--detach', '--checkout',
-                worktree_dir,
-                await self.get_commit_hash(),
-                cwd=await self.root.get_cloned_repo(),
-                check=False,
+        if worktree_dir.exists():
+            touch(worktree_dir)
+            return worktree_dir
+        repo_dir = await self.root.get_synced_repo()
+        tmp_dir = Path(tempfile.mkdtemp(
+            prefix=f'.{worktree_dir.name}.', dir=self.root.cache_dir,
+        ))
+        index_path = tmp_dir.with_name(tmp_dir.name + '.index')
+        try:
+            if self.root.dedup_worktrees:
+                await self._read_tree(repo_dir, index_path)
+                await self.root.blob_store.check_out(
+                    repo_dir, tmp_dir, index_path, commit_hash,
+                    shared_dirs=await self.get_shared_dirs(),
+                )
+            else:
+                await self.root.run_process(
+                    'git', '--git-dir', repo_dir, '--work-tree', tmp_dir,
+                    'read-tree', '--reset', '-u', commit_hash,
+                    env={**os.environ, 'GIT_INDEX_FILE': str(index_path)},
+                )
+            try:
+                tmp_dir.rename(worktree_dir)
+            except OSError:
+                # Someone else (e.g. another process) got there first
+                if not worktree_dir.exists():
+                    raise
+        finally:
+            index_path.unlink(missing_ok=True)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return worktree_dir
+
+    async def _read_tree(self, repo_dir, index_path):
+        await self.root.run_process(
+            'git', '--git-dir', repo_dir,
+            'read-tree', await self.get_commit_hash(),
+            env={**os.environ, 'GIT_INDEX_FILE': str(index_path)},
+        )
+
+    @contextlib.asynccontextmanager
+    async def using_sources(self):
+        """Hold the worktree with all its sources (e.g. for configure & make)
+
+        Dropped sources are checked out again. While any process holds
+        the sources, drop_sources() leaves them alone.
+        """
+        worktree = await self.get_worktree()
+        marker = worktree.with_name(worktree.name + '.partial')
+        with open(worktree.with_name(worktree.name + '.lock'), 'a') as lock:
+            while True:
+                await asyncio.to_thread(fcntl.flock, lock, fcntl.LOCK_SH)
+                if not marker.exists():
+                    break
+                await asyncio.to_thread(fcntl.flock, lock, fcntl.LOCK_EX)
+                if marker.exists():
+                    await self._restore_sources(worktree)
+                    marker.unlink()
+                # Converting the lock isn't atomic: check again with LOCK_SH
+            yield worktree
+
+    async def _restore_sources(self, worktree):
+        repo_dir = await self.root.get_synced_repo()
+        index_path = worktree.with_name(f'.{worktree.name}.restore.index')
+        try:
+            await self._read_tree(repo_dir, index_path)
+            await self.root.blob_store.check_out(
+                repo_dir, worktree, index_path, await self.get_commit_hash(),
+                shared_dirs=await self.get_shared_dirs(),
             )
-            if proc.returncode == 0:
-                break
-            elif proc.returncode == 128:
-                # Git index is locked?
-                await asyncio.sleep(.1 * (2**try_count))
+        finally:
+            index_path.unlink(missing_ok=True)
+
+    async def get_shared_dirs(self):
+        """Get the directories whose files are linked from the BlobStore"""
+        if not self.root.dedup_worktrees:
+            return ()
+        if await self.get_version() < PyVersion(3, 7):
+            # Makefiles of these regenerate headers in Include from
+            # sources elsewhere (e.g. Parser/Python.asdl), which would
+            # be newer than the shared headers
+            return tuple(d for d in SHARED_DIRS if d != 'Include/')
+        return SHARED_DIRS
+
+    async def drop_sources(self):
+        """Remove the worktree's files, except blobstore.SHARED_DIRS
+
+        After make, builds only need those: the interpreter runs with
+        the standard library from Lib, and extensions compile with
+        headers from Include.
+        Returns False (and does nothing) if the sources are in use.
+        """
+        worktree = await self.get_worktree()
+        marker = worktree.with_name(worktree.name + '.partial')
+        with open(worktree.with_name(worktree.name + '.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            if not marker.exists():
+                marker.touch()
+                await asyncio.to_thread(_remove_sources, worktree)
+        return True
+
+    @cached_task
+    async def get_seed_commit(self):
+        """Get a commit whose builds can seed incremental builds of this one
+
+        The choice is recorded next to the worktree: preparing the worktree
+        for a seed changes file timestamps, so it can't change later.
+        The record is only written once the worktree is prepared, and
+        only one process chooses & prepares (under a lock).
+        Returns None if there's no suitable seed.
+        """
+        worktree = await self.get_worktree()
+        marker = worktree.with_name(worktree.name + '.seed')
+        try:
+            seed = marker.read_text().strip()
+        except FileNotFoundError:
+            lock_path = worktree.with_name(worktree.name + '.seed.lock')
+            with open(lock_path, 'a') as lock:
+                await asyncio.to_thread(fcntl.flock, lock, fcntl.LOCK_EX)
+                try:
+                    # Another process may have chosen while we waited
+                    seed = marker.read_text().strip()
+                except FileNotFoundError:
+                    seed = await self._choose_seed()
+                    if seed:
+                        await self._prepare_for_seed(worktree, seed)
+                    tmp = marker.with_name(f'.{marker.name}.{os.getpid()}.tmp')
+                    tmp.write_text(f'{seed or ""}\n')
+                    os.replace(tmp, marker)
+        if not seed:
+            return None
+        return CPythonCommit(self.root, seed)
+
+    async def _choose_seed(self):
+        commit_hash = await self.get_commit_hash()
+        version = await self.get_version()
+        candidates = []
+        for chash in {chash for chash, features, path in find_build_dirs(self.root)}:
+            if chash == commit_hash:
                 continue
-        assert proc.returncode == 0
-        return worktree_dir
+            seed_version = await CPythonCommit(self.root, chash).get_version()
+            if (
+                (seed_version.major, seed_version.minor)
+                == (version.major, version.minor)
+            ):
+                candidates.append((
+                    abs(seed_version.micro - version.micro),
+                    seed_version > version,
+                    chash,
+                ))
+        if not candidates:
+            return None
+        return min(candidates)[-1]
+
+    async def _prepare_for_seed(self, worktree, seed):
+        """Backdate files that are unchanged since the seed commit
+
+        Changed files get the current time. (Seeded builds give them a
+        time after their copy of the seed's build; see
+        touch_changed_since_seed.)
+        """
+        changed = await self._get_changed_since(seed)
+        for dirpath, dirnames, filenames in os.walk(worktree):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if os.path.relpath(path, worktree) not in changed:
+                    st = os.lstat(path)
+                    if st.st_mtime == SEED_MTIME:
+                        # e.g. a shared file
+                        continue
+                    # Don't change the mtime of all links to a shared file
+                    # (one from before shared files got SHARED_MTIME)
+                    break_link(Path(path))
+                    os.utime(
+                        path, (SEED_MTIME, SEED_MTIME),
+                        follow_symlinks=False,
+                    )
+                else:
+                    # Don't touch a file shared with other worktrees
+                    # (see BlobStore); use a private copy
+                    break_link(Path(path))
+                    os.utime(path, follow_symlinks=False)
+
+    async def touch_changed_since_seed(self, newer_than):
+        """Make files changed since the seed commit newer than `newer_than`
+
+        A copy of a seed's build keeps the mtimes of its objects, which
+        can be newer than when the worktree was prepared for the seed
+        (if that build finished later). Without this, make would take
+        those objects as up to date.
+        """
+        seed_commit = await self.get_seed_commit()
+        worktree = await self.get_worktree()
+        mtime = max(time.time(), newer_than + 1)
+        for name in await self._get_changed_since(
+            await seed_commit.get_commit_hash(),
+        ):
+            path = worktree / name
+            try:
+                break_link(path)
+                os.utime(path, (mtime, mtime), follow_symlinks=False)
+            except FileNotFoundError:
+                # Removed since the seed commit
+                pass
+
+    async def _get_changed_since(self, seed):
+        """Get paths of files that differ from the seed commit"""
+        proc = await self.root.run_process(
+            'git', 'diff', '--name-only', '-z', '--no-renames',
+            seed, await self.get_commit_hash(),
+            stdout=subprocess.PIPE,
+            cwd=self.root.cpython_dir,
+        )
+        return {name for name in proc.stdout_data.decode().split('\0') if name}
 
     @cached_task
     async def get_commit_hash(self):
+        refs = await self.root.repo_index.get_refs()
+        try:
+            return refs[self.name]
+        except KeyError:
+            pass
         proc = await self.root.run_process(
             'git', 'rev-parse', self.name + '^{commit}',
             stdout=subprocess.PIPE,
@@ -65,31 +288,32 @@ class CPythonCommit:
         commit_hash = await self.get_commit_hash()
         if commit_hash == '0' * 40:
             return PyVersion.from_hex(0)
-        for name in 'README.rst', 'README':
-            proc = await self.root.run_process(
-                'git', 'show', f'{commit_hash}:{name}',
-                stdout=subprocess.PIPE,
-                cwd=self.root.cpython_dir,
-                check=False,
-            )
-            if proc.returncode == 0:
-                break
-        else:
-            raise LookupError(f'README not found in commit {commit_hash}')
-        firstline, sep, rest = proc.stdout_data.partition(b'\n')
-        match = readme_re.match(firstline)
-        ver_string = match['version'].decode()
-        self._version = PyVersion.parse(ver_string)
+        self._version = await self.root.repo_index.get_version(commit_hash)
         return self._version
 
 
+def _remove_sources(worktree):
+    keep = {name.rstrip('/') for name in SHARED_DIRS}
+    for path in worktree.iterdir():
+        if path.name in keep:
+            continue
+        if path.is_dir() and not path.is_symlink():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+
+
+def find_build_dirs(root):
+    """Yield (commit_hash, feature_tags, path) of completed build dirs"""
+    for path in root.cache_dir.glob('build-*-*'):
+        tag, sep, commit_hash = path.name.removeprefix('build-').rpartition('-')
+        if len(commit_hash) == 40 and (path / 'python').exists():
+            name, sep, features = tag.partition('~')
+            yield commit_hash, features, path
+
+
 async def get_tagged_commits(root):
-    proc = await root.run_process(
-        'git', 'tag',
-        stdout=subprocess.PIPE,
-        cwd=root.cpython_dir,
-    )
     return [
-        CPythonCommit(root, line)
-        for line in proc.stdout_data.decode().splitlines()
+        CPythonCommit(root, name)
+        for name in await root.repo_index.get_tag_names()
     ]
@@ -0,0 +1,144 @@
+"""Minimal reader for the dynamic symbol tables of ELF files"""
+
+import dataclasses
+import struct
+import json
+import mmap
+import os
+
+SHT_DYNSYM = 11
+SHN_UNDEF = 0
+STB_GLOBAL = 1
+STB_WEAK = 2
+STV_DEFAULT = 0
+STV_PROTECTED = 3
+
+# (header after e_ident, section header, symbol) formats, by EI_CLASS
+_FORMATS = {
+    1: ('HHIIIIIHHHHHH', 'IIIIIIIIII', 'IIIBBH'),
+    2: ('HHIQQQIHHHHHH', 'IIQQQQIIQQ', 'IBBHQQ'),
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class DynamicSymbols:
+    """Names in a .dynsym table
+
+    `undefined` are (non-weak) symbols the file needs from elsewhere;
+    `defined` are the ones it exports.
+    """
+    undefined: frozenset
+    defined: frozenset
+
+
+def read_dynamic_symbols(path):
+    """Read the dynamic symbols of an ELF file; None if it's not ELF"""
+    undefined = set()
+    defined = set()
+    symbols = _read(path)
+    if symbols is None:
+        return None
+    for name, binding, visibility, shndx, size in symbols:
+        if shndx == SHN_UNDEF:
+            if binding == STB_GLOBAL:
+                undefined.add(name)
+        elif (
+            binding in (STB_GLOBAL, STB_WEAK)
+            and visibility in (STV_DEFAULT, STV_PROTECTED)
+        ):
+            defined.add(name)
+    return DynamicSymbols(frozenset(undefined), frozenset(defined))
+
+
+def read_symbol_sizes(path):
+    """Map names of defined dynamic symbols to their sizes (st_size)"""
+    symbols = _read(path)
+    if symbols is None:
+        raise ValueError(f'not an ELF file: {path}')
+    return {
+        name: size
+        for name, binding, visibility, shndx, size in symbols
+        if shndx != SHN_UNDEF
+    }
+
+
+def _read(path):
+    """List (name, binding, visibility, shndx, size) of .dynsym entries"""
+    with open(path, 'rb') as f:
+        if f.read(4) != b'\x7fELF':
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return _parse(data)
+
+
+def _parse(data):
+    ei_class = data[4]
+    byteorder = {1: '<', 2: '>'}[data[5]]
+    header_fmt, section_fmt, symbol_fmt = (
+        struct.Struct(byteorder + fmt) for fmt in _FORMATS[ei_class]
+    )
+    (
+        e_type, e_machine, e_version, e_entry, e_phoff, e_shoff, e_flags,
+        e_ehsize, e_phentsize, e_phnum, e_shentsize, e_shnum, e_shstrndx,
+    ) = header_fmt.unpack_from(data, 16)
+
+    def section(index):
+        name, type, flags, addr, offset, size, link, *rest = (
+            section_fmt.unpack_from(data, e_shoff + index * e_shentsize)
+        )
+        return type, offset, size, link
+
+    if e_shoff and not e_shnum:
+        # Extended numbering: the real count is in section 0
+        e_shnum = section(0)[2]
+    result = []
+    for index in range(e_shnum):
+        type, offset, size, link = section(index)
+        if type != SHT_DYNSYM:
+            continue
+        strtab_type, strtab_offset, strtab_size, _ = section(link)
+        for fields in symbol_fmt.iter_unpack(data[offset:offset + size]):
+            if ei_class == 1:
+                st_name, st_value, st_size, st_info, st_other, st_shndx = fields
+            else:
+                st_name, st_info, st_other, st_shndx, st_value, st_size = fields
+            if not st_name:
+                continue
+            start = strtab_offset + st_name
+            name = data[start:data.find(b'\0', start)].decode()
+            result.append((name, st_info >> 4, st_other & 3, st_shndx, st_size))
+    return result
+
+
+def get_dynamic_symbols(path):
+    """Like read_dynamic_symbols, but cached in a file next to path
+
+    The cache is used only if path wasn't changed since it was written.
+    """
+    cache_path = path.with_name(f'{path.name}.symbols.json')
+    st = path.stat()
+    stamp = [st.st_ino, st.st_size, st.st_mtime_ns]
+    try:
+        cached = json.loads(cache_path.read_text())
+    except FileNotFoundError:
+        pass
+    else:
+        if cached['stamp'] == stamp:
+            if cached['symbols'] is None:
+                return None
+            return DynamicSymbols(
+                frozenset(cached['symbols']['undefined']),
+                frozenset(cached['symbols']['defined']),
+            )
+    symbols = read_dynamic_symbols(path)
+    if symbols is None:
+        content = None
+    else:
+        content = {
+            'undefined': sorted(symbols.undefined),
+            'defined': sorted(symbols.defined),
+        }
+    tmp = cache_path.with_name(f'.{cache_path.name}.{os.getpid()}.tmp')
+    tmp.write_text(json.dumps({'stamp': stamp, 'symbols': content}))
+    os.replace(tmp, cache_path)
+    return symbols
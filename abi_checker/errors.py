@@ -3,3 +3,9 @@ class SkipBuild(Exception):
 
 class ExpectFailure(Exception):
     """This build has an expected failure"""
+
+class ProcessTimeout(Exception):
+    """A process took too long, and was killed"""
+
+class ExecServerDied(Exception):
+    """An ExecServer's zygote exited, so it can't run the request"""
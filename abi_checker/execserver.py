@@ -0,0 +1,152 @@
+from pathlib import Path
+import subprocess
+import contextlib
+import itertools
+import asyncio
+import types
+import json
+import os
+
+from .errors import ProcessTimeout, ExecServerDied
+from .util import kill_process_group
+
+ZYGOTE_PATH = Path(__file__).parent / 'zygote.py'
+
+
+class ExecServer:
+    """A warm interpreter of an exec build that forks a child for each run
+
+    See zygote.py for the other side.
+    If the zygote dies, runs that were sent to it fail, and later ones
+    raise ExecServerDied right away (see `alive`).
+    """
+
+    def __init__(self, root, build, executable):
+        self.root = root
+        self.build = build
+        self.executable = executable
+        self._ids = itertools.count()
+        self._futures = {}
+        self._pids = {}
+        self._kill_requested = set()
+        self._proc = None
+        self._reader = None
+
+    def __repr__(self):
+        return f'<ExecServer {self.executable}>'
+
+    @property
+    def alive(self):
+        """False once the zygote's output ended (e.g. it died)"""
+        return self._reader is not None and not self._reader.done()
+
+    async def start(self):
+        env = {k: v for k, v in os.environ.items() if k != 'PYTHONPATH'}
+        self._proc = await asyncio.create_subprocess_exec(
+            self.executable, ZYGOTE_PATH,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env,
+        )
+        self._reader = asyncio.create_task(
+            self._read_responses(),
+            name=f'reader of {self!r}',
+        )
+
+    async def aclose(self):
+        self._proc.stdin.close()
+        await self._proc.wait()
+        await self._reader
+
+    async def run_script(
+        self, script, *, cwd, stdout, stderr, env, timeout=None, rlimits=None,
+        case=None,
+    ):
+        """Run script in a forked child; like Root.run_process(check=False)
+        """
+        request_id = next(self._ids)
+        request = dict(
+            id=request_id,
+            script=str(script),
+            cwd=str(cwd),
+            stdout=str(stdout),
+            stderr=str(stderr),
+            env={k: str(v) for k, v in env.items()},
+            rlimits=rlimits or {},
+        )
+        if timeout is None:
+            timeout = self.root.get_timeout('exec')
+        async with contextlib.AsyncExitStack() as cm:
+            await cm.enter_async_context(
+                self.root.scheduler.slot('exec', self.build),
+            )
+            if not self.alive:
+                raise ExecServerDied(f'{self!r} exited')
+            print('starting:', ('fork', self.executable, script))
+            span = cm.enter_context(self.root.tracer.span(
+                'process', f'fork {os.path.basename(script)}',
+                stage='exec',
+                build=self.build.tag,
+                case=None if case is None else case.name,
+            ))
+            # With the reader still running, it resolves the future
+            future = asyncio.get_running_loop().create_future()
+            self._futures[request_id] = future
+            try:
+                self._proc.stdin.write(json.dumps(request).encode() + b'\n')
+                await self._proc.stdin.drain()
+            except ConnectionError as e:
+                # The zygote died before it got the request
+                self._futures.pop(request_id, None)
+                raise ExecServerDied(f'{self!r} exited') from e
+            try:
+                async with asyncio.timeout(timeout):
+                    response = await asyncio.shield(future)
+            except TimeoutError:
+                self._kill(request_id)
+                await future
+                raise ProcessTimeout(
+                    f'{script} in {self!r} timed out after {timeout}s',
+                )
+            finally:
+                if not future.done():
+                    # Cancelled
+                    self._kill(request_id)
+            span.returncode = response['returncode']
+            span.cpu_time = response.get('cpu_time')
+            span.max_rss = response.get('max_rss')
+            self.root.memory_gate.observe('exec', span.max_rss)
+            print('done    :', ('fork', self.executable, script))
+        return types.SimpleNamespace(
+            stdout_data=None,
+            stderr_data=None,
+            returncode=response['returncode'],
+        )
+
+    def _kill(self, request_id):
+        """Kill a child (and its process group), once its pid is known"""
+        try:
+            pid = self._pids[request_id]
+        except KeyError:
+            self._kill_requested.add(request_id)
+        else:
+            kill_process_group(pid)
+
+    async def _read_responses(self):
+        async for line in self._proc.stdout:
+            response = json.loads(line)
+            request_id = response['id']
+            if 'pid' in response:
+                self._pids[request_id] = response['pid']
+                if request_id in self._kill_requested:
+                    self._kill_requested.discard(request_id)
+                    self._kill(request_id)
+            if 'returncode' in response:
+                self._pids.pop(request_id, None)
+                future = self._futures.pop(request_id)
+                future.set_result(response)
+        for future in self._futures.values():
+            future.set_exception(
+                RuntimeError(f'{self!r} exited with {self._proc.returncode}'),
+            )
+        self._futures.clear()
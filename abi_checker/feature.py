@@ -6,6 +6,7 @@ class Feature:
     tag: str
     config_options: tuple = ()
     cflags: tuple = ()
+    fork_safe: bool = True
 
     async def verify_compatibility(self, commit):
         pass
@@ -18,6 +19,7 @@ class FreeThreading(Feature):
     tag = 't'
     config_options = ('--disable-gil',)
     cflags = ('-DPy_GIL_DISABLED=1',)
+    fork_safe = False
     min_version = PyVersion(3, 13)
 
     async def verify_compatibility(self, build):
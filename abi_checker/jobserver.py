@@ -0,0 +1,151 @@
+from pathlib import Path
+import contextlib
+import itertools
+import tempfile
+import asyncio
+import termios
+import array
+import fcntl
+import heapq
+import shutil
+import os
+
+
+class JobPipe:
+    """A GNU make jobserver pipe: a named pipe of tokens, one byte each
+
+    Our ends are non-blocking. A make started with `make_kwargs()` gets
+    blocking ends: each open() of a FIFO is a separate file description,
+    so our non-blocking ends don't affect the ones given to make.
+    """
+
+    def __init__(self):
+        self._tmpdir = Path(tempfile.mkdtemp(prefix='abi_checker-jobserver-'))
+        path = self._tmpdir / 'fifo'
+        os.mkfifo(path)
+        self.read_fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        self.write_fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        make_read_fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        os.set_blocking(make_read_fd, True)
+        make_write_fd = os.open(path, os.O_WRONLY)
+        self._make_fds = make_read_fd, make_write_fd
+
+    def close(self):
+        for fd in self.read_fd, self.write_fd, *self._make_fds:
+            os.close(fd)
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    def put(self, tokens):
+        os.write(self.write_fd, tokens)
+
+    def take(self):
+        """Take a token; raise BlockingIOError if there's none"""
+        return os.read(self.read_fd, 1)
+
+    def count(self):
+        """Number of tokens in the pipe"""
+        buf = array.array('i', [0])
+        fcntl.ioctl(self.read_fd, termios.FIONREAD, buf)
+        return buf[0]
+
+    def make_kwargs(self, jobs, env=None):
+        """Extra arguments for subprocess.Popen() to run make"""
+        read_fd, write_fd = self._make_fds
+        return dict(
+            env={
+                **(os.environ if env is None else env),
+                'MAKEFLAGS': (
+                    f' -j{jobs} --jobserver-auth={read_fd},{write_fd}'
+                ),
+            },
+            pass_fds=self._make_fds,
+        )
+
+
+class JobServer:
+    """Token-based process limit
+
+    The tokens are bytes in a JobPipe. Every process we start holds one
+    token while it runs. A make's parallel jobs need additional tokens:
+    they're lent to it through a JobPipe of its own (see
+    scheduler.MakeJobs), so total parallelism stays at `jobs`.
+
+    When tokens run out, waiters get them in order of priority (lowest
+    first), then first come first served. Priorities are given as
+    functions, and re-evaluated on `reprioritize()`.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self._pipe = JobPipe()
+        self._pipe.put(b'+' * jobs)
+        self._held = 0
+        self._waiters = []  # heap of [priority, seq, future, get_priority]
+        self._seq = itertools.count()
+        self._reading = False
+
+    def close(self):
+        self._pipe.close()
+
+    @contextlib.asynccontextmanager
+    async def token(self, *, priority=tuple):
+        """Hold a token while the body runs"""
+        token = await self._acquire(priority)
+        try:
+            yield token
+        finally:
+            self._release(token)
+
+    async def _acquire(self, priority):
+        if not self._waiters:
+            try:
+                token = self._pipe.take()
+            except BlockingIOError:
+                pass
+            else:
+                self._held += 1
+                return token
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(
+            self._waiters, [priority(), next(self._seq), future, priority],
+        )
+        self._update_reader()
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(future.result())
+            raise
+
+    def _release(self, token):
+        self._held -= 1
+        self._pipe.put(token)
+
+    def reprioritize(self):
+        for entry in self._waiters:
+            entry[0] = entry[3]()
+        heapq.heapify(self._waiters)
+
+    def _update_reader(self):
+        loop = asyncio.get_running_loop()
+        if self._waiters and not self._reading:
+            loop.add_reader(self._pipe.read_fd, self._on_readable)
+            self._reading = True
+        elif self._reading and not self._waiters:
+            loop.remove_reader(self._pipe.read_fd)
+            self._reading = False
+
+    def _on_readable(self):
+        while self._waiters:
+            priority, seq, future, get_priority = self._waiters[0]
+            if future.cancelled():
+                heapq.heappop(self._waiters)
+                continue
+            try:
+                token = self._pipe.take()
+            except BlockingIOError:
+                break
+            heapq.heappop(self._waiters)
+            self._held += 1
+            future.set_result(token)
+        self._update_reader()
@@ -0,0 +1,214 @@
+"""Sizes, alignments and member offsets of C API structs
+
+A generated C file records each number as the size of an exported array;
+it's compiled like a test extension, and the numbers are read back from
+the result's dynamic symbol table. Nothing is executed, so one compile
+per build & compile options gives the whole table.
+"""
+
+import dataclasses
+import tempfile
+import json
+import os
+
+from .util import cached_task
+from .build import Build
+from .compileoptions import CompileOptions
+from .elf import read_symbol_sizes
+
+NOT_LIMITED = '!defined(Py_LIMITED_API)'
+
+# (struct, condition, members); members are names or (name, condition)
+STRUCTS = (
+    ('PyObject', None, (
+        ('ob_refcnt', '!defined(Py_GIL_DISABLED)'),
+        ('ob_tid', 'defined(Py_GIL_DISABLED)'),
+        ('ob_ref_local', 'defined(Py_GIL_DISABLED)'),
+        ('ob_ref_shared', 'defined(Py_GIL_DISABLED)'),
+        'ob_type',
+    )),
+    ('PyVarObject', None, ('ob_base', 'ob_size')),
+    ('PyTypeObject', NOT_LIMITED, (
+        'tp_name', 'tp_basicsize', 'tp_itemsize', 'tp_dealloc',
+        ('tp_vectorcall_offset', 'PY_VERSION_HEX >= 0x03080000'),
+        'tp_getattr', 'tp_setattr', 'tp_as_async', 'tp_repr',
+        'tp_as_number', 'tp_as_sequence', 'tp_as_mapping', 'tp_hash',
+        'tp_call', 'tp_str', 'tp_getattro', 'tp_setattro', 'tp_as_buffer',
+        'tp_flags', 'tp_doc', 'tp_traverse', 'tp_clear', 'tp_richcompare',
+        'tp_weaklistoffset', 'tp_iter', 'tp_iternext', 'tp_methods',
+        'tp_members', 'tp_getset', 'tp_base', 'tp_dict', 'tp_descr_get',
+        'tp_descr_set', 'tp_dictoffset', 'tp_init', 'tp_alloc', 'tp_new',
+        'tp_free', 'tp_is_gc', 'tp_bases', 'tp_mro', 'tp_cache',
+        'tp_subclasses', 'tp_weaklist', 'tp_del', 'tp_version_tag',
+        'tp_finalize',
+        ('tp_vectorcall', 'PY_VERSION_HEX >= 0x03080000'),
+        ('tp_watched', 'PY_VERSION_HEX >= 0x030c0000'),
+    )),
+    ('PyNumberMethods', NOT_LIMITED, (
+        'nb_add', 'nb_bool', 'nb_int', 'nb_index', 'nb_matrix_multiply',
+        'nb_inplace_matrix_multiply',
+    )),
+    ('PySequenceMethods', NOT_LIMITED, (
+        'sq_length', 'sq_item', 'sq_contains', 'sq_inplace_repeat',
+    )),
+    ('PyMappingMethods', NOT_LIMITED, (
+        'mp_length', 'mp_subscript', 'mp_ass_subscript',
+    )),
+    ('PyAsyncMethods', NOT_LIMITED, (
+        'am_await', 'am_aiter', 'am_anext',
+        ('am_send', 'PY_VERSION_HEX >= 0x030a0000'),
+    )),
+    ('PyBufferProcs', (
+        '!defined(Py_LIMITED_API) || Py_LIMITED_API+0 >= 0x030b0000'
+    ), (
+        'bf_getbuffer', 'bf_releasebuffer',
+    )),
+    ('Py_buffer', (
+        '!defined(Py_LIMITED_API) || Py_LIMITED_API+0 >= 0x030b0000'
+    ), (
+        'buf', 'obj', 'len', 'itemsize', 'readonly', 'ndim', 'format',
+        'shape', 'strides', 'suboffsets', 'internal',
+    )),
+    ('PyModuleDef_Base', None, ('ob_base', 'm_init', 'm_index', 'm_copy')),
+    ('PyModuleDef', None, (
+        'm_base', 'm_name', 'm_doc', 'm_size', 'm_methods', 'm_slots',
+        'm_traverse', 'm_clear', 'm_free',
+    )),
+    ('PyModuleDef_Slot', None, ('slot', 'value')),
+    ('PyMethodDef', None, ('ml_name', 'ml_meth', 'ml_flags', 'ml_doc')),
+    ('PyMemberDef', None, ('name', 'type', 'offset', 'flags', 'doc')),
+    ('PyGetSetDef', None, ('name', 'get', 'set', 'doc', 'closure')),
+    ('PyType_Slot', None, ('slot', 'pfunc')),
+    ('PyType_Spec', None, ('name', 'basicsize', 'itemsize', 'flags', 'slots')),
+)
+
+
+def generate_probe_source():
+    lines = [
+        '#define PY_SSIZE_T_CLEAN',
+        '#include <Python.h>',
+        '#include <structmember.h>',
+        '#include <stddef.h>',
+        '',
+        '/* Each number N is recorded as the size (N+1) of an array */',
+        '#define RECORD(name, value) char layout__##name[(value) + 1];',
+        '#define ALIGNOF(type) offsetof(struct {char c; type x;}, x)',
+    ]
+    for struct_name, condition, members in STRUCTS:
+        lines.append('')
+        if condition:
+            lines.append(f'#if {condition}')
+        lines.append(f'RECORD({struct_name}__size, sizeof({struct_name}))')
+        lines.append(f'RECORD({struct_name}__align, ALIGNOF({struct_name}))')
+        for member in members:
+            if isinstance(member, str):
+                member_condition = None
+            else:
+                member, member_condition = member
+            if member_condition:
+                lines.append(f'#if {member_condition}')
+            lines.append(
+                f'RECORD({struct_name}__{member}, '
+                + f'offsetof({struct_name}, {member}))'
+            )
+            if member_condition:
+                lines.append('#endif')
+        if condition:
+            lines.append('#endif')
+    return '\n'.join(lines) + '\n'
+
+
+def parse_symbol_sizes(sizes):
+    """Turn sizes of the layout__* symbols into a layout dict
+
+    The result maps struct names to {'size': ..., 'align': ...,
+    'offsets': {member: offset}}.
+    """
+    layout = {}
+    for symbol, size in sizes.items():
+        prefix, sep, rest = symbol.partition('layout__')
+        if prefix or not sep:
+            continue
+        struct_name, sep, item = rest.partition('__')
+        info = layout.setdefault(
+            struct_name, {'size': None, 'align': None, 'offsets': {}},
+        )
+        if item in ('size', 'align'):
+            info[item] = size - 1
+        else:
+            info['offsets'][item] = size - 1
+    return {
+        name: {**info, 'offsets': dict(sorted(
+            info['offsets'].items(), key=lambda item: item[1],
+        ))}
+        for name, info in sorted(layout.items())
+    }
+
+
+@dataclasses.dataclass
+class LayoutProbe:
+    """Layout of C API structs as seen by extensions compiled with a build"""
+    build: Build
+    compile_options: CompileOptions
+
+    @property
+    def root(self):
+        return self.build.root
+
+    @cached_task
+    async def get_layout(self):
+        """Get the layout dict (see parse_symbol_sizes); None on failure
+
+        It's recorded in the build directory.
+        """
+        build_dir = await self.build.get_build_dir()
+        basename = f'abi_checker_layout-{self.compile_options.tag}'
+        path = build_dir / f'{basename}.json'
+        log_path = build_dir / f'{basename}.log'
+        try:
+            return json.loads(path.read_text())
+        except FileNotFoundError:
+            pass
+        try:
+            layout = await self._probe(log_path)
+        except Exception:
+            # The build failed, or the probe timed out
+            return None
+        if layout is None:
+            return None
+        tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+        tmp.write_text(json.dumps(layout, indent=1))
+        os.replace(tmp, path)
+        return layout
+
+    async def _probe(self, log_path):
+        """Compile the probe and read the layout; None if it doesn't compile
+        """
+        await self.build.get_executable()
+        root = self.root
+        flags = list(await self.build.get_flags())
+        flags.extend(self.compile_options.cflags)
+        for feature in self.build.features:
+            flags.extend(feature.cflags)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source_path = os.path.join(tmpdir, 'layout_probe.c')
+            output_path = os.path.join(tmpdir, 'layout_probe.so')
+            with open(source_path, 'w') as f:
+                f.write(generate_probe_source())
+            proc = await root.run_process(
+                await self.build.get_compiler(),
+                *flags,
+                '--shared',
+                source_path,
+                '-o', output_path,
+                '-fPIC',
+                stdout=log_path,
+                stderr=log_path,
+                cwd=tmpdir,
+                check=False,
+                stage='compile',
+                build=self.build,
+            )
+            if proc.returncode != 0:
+                return None
+            return parse_symbol_sizes(read_symbol_sizes(output_path))
@@ -0,0 +1,155 @@
+"""Logs of runs, packed into a few files per build"""
+
+from pathlib import Path
+import argparse
+import asyncio
+import fcntl
+import json
+import zlib
+import sys
+import os
+
+
+class LogStore:
+    """Log records, addressed by build tag, key and log name
+
+    Each build has a pack file of zlib-compressed records (logs/TAG.pack),
+    and an index (logs/TAG.idx) with a JSON line per record:
+    [key, name, offset, length, crc32]. Records are only appended; for
+    a key & name that's recorded again, the last record wins (but the same
+    contents aren't recorded again). Appends from several processes are
+    serialized with a lock on the pack file.
+
+    Keys are run tags (CASE/BUILD/OPTS/BUILD, for exec logs in the exec
+    build's pack) and test module tags (CASE/BUILD/OPTS, for compile logs
+    in the compile build's pack). They're also paths under runs/, where
+    logs are kept if the store isn't used (see Root.pack_logs); `get`
+    falls back to those.
+    """
+
+    def __init__(self, cache_dir):
+        self.path = cache_dir / 'logs'
+        self.runs_path = cache_dir / 'runs'
+        # build_tag: [inode of the index, bytes of it read, {...}]
+        self._indexes = {}
+
+    def _get_paths(self, build_tag):
+        return (
+            self.path / f'{build_tag}.pack',
+            self.path / f'{build_tag}.idx',
+        )
+
+    async def put(self, build_tag, key, name, data):
+        crc = zlib.crc32(data)
+        location = self._get_index(build_tag).get((key, name))
+        if location is not None and location[2] == crc:
+            return
+        # Waiting for the lock (and compressing) shouldn't block the loop
+        await asyncio.to_thread(self._append, build_tag, key, name, data, crc)
+
+    def _append(self, build_tag, key, name, data, crc):
+        record = zlib.compress(data)
+        pack_path, index_path = self._get_paths(build_tag)
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(pack_path, 'ab') as pack:
+            fcntl.flock(pack, fcntl.LOCK_EX)
+            offset = pack.seek(0, os.SEEK_END)
+            pack.write(record)
+            pack.flush()
+            with open(index_path, 'a') as index:
+                index.write(
+                    json.dumps([key, name, offset, len(record), crc]) + '\n',
+                )
+
+    async def put_file(self, build_tag, key, name, path):
+        """Store the contents of a file, if it exists"""
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return
+        await self.put(build_tag, key, name, data)
+
+    def get(self, build_tag, key, name):
+        """Get the contents of a log, or None if there's no such log"""
+        location = self._get_index(build_tag).get((key, name))
+        if location is None:
+            try:
+                return (self.runs_path / key / name).read_bytes()
+            except FileNotFoundError:
+                return None
+        offset, length, crc = location
+        pack_path, index_path = self._get_paths(build_tag)
+        with open(pack_path, 'rb') as pack:
+            pack.seek(offset)
+            return zlib.decompress(pack.read(length))
+
+    def _get_index(self, build_tag):
+        """Get {(key, name): (offset, length, crc32)}, reading what other
+        processes (or we) appended since last time"""
+        inode, read, index = self._indexes.setdefault(build_tag, [None, 0, {}])
+        pack_path, index_path = self._get_paths(build_tag)
+        try:
+            f = open(index_path, 'rb')
+        except FileNotFoundError:
+            # Removed (e.g. by gc), or not written yet
+            self._indexes[build_tag] = [None, 0, {}]
+            return {}
+        with f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != inode or st.st_size < read:
+                # New, or removed (e.g. by gc) and started again
+                read, index = 0, {}
+                self._indexes[build_tag] = [st.st_ino, read, index]
+            f.seek(read)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Still being written
+                    break
+                key, name, *location = json.loads(line)
+                index[key, name] = tuple(location)
+                read += len(line)
+        self._indexes[build_tag][1] = read
+        return index
+
+
+def get_run_logs(store, run_key):
+    """Get {name: contents} of all logs of a run, given its tag"""
+    case, compile_build, compile_options, exec_build = run_key.split('/')
+    module_key = f'{case}/{compile_build}/{compile_options}'
+    result = {}
+    for build_tag, key, name in (
+        (compile_build, module_key, 'compile.log'),
+        (exec_build, run_key, 'exec_origin'),
+        (exec_build, run_key, 'stdout.log'),
+        (exec_build, run_key, 'stderr.log'),
+    ):
+        data = store.get(build_tag, key, name)
+        if data is not None:
+            result[name] = data
+    return result
+
+
+async def main(argv):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description='Print the logs of a run.',
+    )
+    parser.add_argument(
+        'run', metavar='RUN',
+        help='the run, as CASE/COMPILE_BUILD/COMPILE_OPTS/EXEC_BUILD '
+            + '(like in the URL of its page)')
+    parser.add_argument(
+        '--cache_dir',
+        type=Path,
+        default=Path('.cache'),
+        help='Cache directory.')
+    args = parser.parse_args(argv[1:])
+    logs = get_run_logs(LogStore(args.cache_dir.resolve()), args.run.strip('/'))
+    if not logs:
+        print(f'no logs for {args.run}', file=sys.stderr)
+        return 1
+    for name, data in logs.items():
+        print(f'==> {name} <==')
+        sys.stdout.write(data.decode(errors='replace'))
+        if data and not data.endswith(b'\n'):
+            print()
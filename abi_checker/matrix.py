@@ -0,0 +1,192 @@
+import collections
+
+from .runresult import RunResult, Expectation
+
+# Result codes: 0 for a result that's not known yet, then RunResults
+_RESULTS = (None, *RunResult)
+_CODES = {result: code for code, result in enumerate(_RESULTS)}
+
+# Same for Expectations
+_EXPECTATIONS = (None, *Expectation)
+_EXPECTATION_CODES = {e: code for code, e in enumerate(_EXPECTATIONS)}
+
+
+class ResultMatrix:
+    """Results of all cells of a report, one byte per cell
+
+    A cell is a (case, compile build, compile options, exec build).
+    Compile builds and their options form one axis, `rows`.
+    Cells are numbered case-major, then by row, then by exec build.
+
+    Besides result codes, the matrix only holds exception messages
+    (e.g. why a run was skipped; equal messages are shared) and, for
+    cells with the ERROR result, the exceptions themselves.
+
+    Expectations (see Report.get_expectations) are also kept one byte
+    per cell; they're filled in a whole case at a time.
+    """
+
+    def __init__(self, cases, rows, exec_builds):
+        self.cases = list(cases)
+        self.rows = list(rows)
+        self.exec_builds = list(exec_builds)
+        self._case_indices = {c.tag: i for i, c in enumerate(self.cases)}
+        self._row_indices = {
+            (build.tag, opts.tag): i
+            for i, (build, opts) in enumerate(self.rows)
+        }
+        self._exec_indices = {b.tag: i for i, b in enumerate(self.exec_builds)}
+        self.codes = bytearray(len(self))
+        self.expectations = bytearray(len(self))
+        self.messages = {}
+        self.errors = {}
+        self._message_pool = {}
+
+    def __len__(self):
+        return len(self.cases) * len(self.rows) * len(self.exec_builds)
+
+    def index(self, case, compile_build, compile_options, exec_build):
+        row = self._row_indices[compile_build.tag, compile_options.tag]
+        return (
+            (self._case_indices[case.tag] * len(self.rows) + row)
+            * len(self.exec_builds)
+            + self._exec_indices[exec_build.tag]
+        )
+
+    def find(self, case, compile_build, compile_options, exec_build):
+        """Get the index of a cell, or None if it's not in the matrix
+
+        The builds must be the matrix's own Build objects, not just have
+        the same tags (they don't after a ref moves; see Report.refresh).
+        """
+        row = self._row_indices.get((compile_build.tag, compile_options.tag))
+        exec_index = self._exec_indices.get(exec_build.tag)
+        if (
+            row is None or exec_index is None
+            or self.rows[row][0] is not compile_build
+            or self.exec_builds[exec_index] is not exec_build
+        ):
+            return None
+        return self.index(case, compile_build, compile_options, exec_build)
+
+    def get_cell(self, index):
+        """Get (case, compile_build, compile_options, exec_build)"""
+        rest, exec_index = divmod(index, len(self.exec_builds))
+        case_index, row = divmod(rest, len(self.rows))
+        compile_build, compile_options = self.rows[row]
+        return (
+            self.cases[case_index], compile_build, compile_options,
+            self.exec_builds[exec_index],
+        )
+
+    def get(self, index):
+        """Get the RunResult of a cell, or None if it's not known yet"""
+        return _RESULTS[self.codes[index]]
+
+    def get_message(self, index):
+        return self.messages.get(index)
+
+    def set(self, index, result, exception=None):
+        self.codes[index] = _CODES[result]
+        if exception is not None:
+            message = str(exception)
+            self.messages[index] = self._message_pool.setdefault(
+                message, message,
+            )
+            if result == RunResult.ERROR:
+                self.errors[index] = exception
+
+    def get_expectation(self, index):
+        """Get the Expectation of a cell, or None if it's not known yet"""
+        return _EXPECTATIONS[self.expectations[index]]
+
+    def has_expectations(self, case):
+        start, stop = self._case_range(case)
+        return self.expectations.find(0, start, stop) == -1
+
+    def set_expectations(self, case, expectations):
+        """Set Expectations for all cells of a case, in matrix order"""
+        start, stop = self._case_range(case)
+        codes = bytes(_EXPECTATION_CODES[e] for e in expectations)
+        if len(codes) != stop - start:
+            raise ValueError(f'need {stop - start} expectations')
+        self.expectations[start:stop] = codes
+
+    def _case_range(self, case):
+        size = len(self.rows) * len(self.exec_builds)
+        start = self._case_indices[case.tag] * size
+        return start, start + size
+
+    def iter_row(self, case, compile_build, compile_options):
+        """Yield (exec_build, result, message, expectation) for one row
+        of one case"""
+        if not self.exec_builds:
+            return
+        start = self.index(
+            case, compile_build, compile_options, self.exec_builds[0],
+        )
+        for index, exec_build in enumerate(self.exec_builds, start=start):
+            yield (
+                exec_build,
+                _RESULTS[self.codes[index]],
+                self.messages.get(index),
+                _EXPECTATIONS[self.expectations[index]],
+            )
+
+    def copy_results(self, other):
+        """Copy results & expectations of cells that are also in `other`
+
+        Cells only match if their builds are the same Build objects.
+        """
+        rows = [
+            (i, j) for i, (build, opts) in enumerate(other.rows)
+            if (j := self._row_indices.get((build.tag, opts.tag))) is not None
+            and self.rows[j][0] is build
+        ]
+        execs = [
+            (i, j) for i, build in enumerate(other.exec_builds)
+            if (j := self._exec_indices.get(build.tag)) is not None
+            and self.exec_builds[j] is build
+        ]
+        self._message_pool.update(other._message_pool)
+        for old_case, case in enumerate(other.cases):
+            new_case = self._case_indices.get(case.tag)
+            if new_case is None:
+                continue
+            for old_row, new_row in rows:
+                old_start = (
+                    (old_case * len(other.rows) + old_row)
+                    * len(other.exec_builds)
+                )
+                new_start = (
+                    (new_case * len(self.rows) + new_row)
+                    * len(self.exec_builds)
+                )
+                for old_exec, new_exec in execs:
+                    old = old_start + old_exec
+                    new = new_start + new_exec
+                    self.codes[new] = other.codes[old]
+                    self.expectations[new] = other.expectations[old]
+                    if old in other.messages:
+                        self.messages[new] = other.messages[old]
+                    if old in other.errors:
+                        self.errors[new] = other.errors[old]
+
+    def get_compile_groups(self):
+        """Get [(compile_build, [compile_options, ...]), ...]"""
+        groups = {}
+        for build, opts in self.rows:
+            groups.setdefault(build.tag, (build, []))[1].append(opts)
+        return list(groups.values())
+
+    def count(self):
+        """Count cells by result (None for the unknown ones)"""
+        return collections.Counter({
+            result: count
+            for result, code in _CODES.items()
+            if (count := self.codes.count(code))
+        })
+
+    @property
+    def complete(self):
+        return 0 not in self.codes
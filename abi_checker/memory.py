@@ -0,0 +1,174 @@
+"""Admission control based on memory use"""
+
+import collections
+import contextlib
+import itertools
+import asyncio
+import time
+
+# Guesses of peak RSS per process, used until a stage's process is seen
+DEFAULT_PEAKS = {
+    'other': 64 * 2**20,
+    'exec': 128 * 2**20,
+    'compile': 256 * 2**20,
+    'configure': 128 * 2**20,
+    'make': 512 * 2**20,
+}
+
+
+def read_meminfo(path='/proc/meminfo'):
+    """Read /proc/meminfo into a dict of sizes in bytes
+
+    Returns an empty dict if the file isn't available.
+    """
+    result = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                name, sep, value = line.partition(':')
+                words = value.split()
+                if sep and words:
+                    size = int(words[0])
+                    if words[1:] == ['kB']:
+                        size *= 1024
+                    result[name] = size
+    except FileNotFoundError:
+        pass
+    return result
+
+
+class MemoryGate:
+    """Holds back processes that would need more memory than is left
+
+    While a process runs, it has a reservation: the highest peak RSS seen
+    so far for a process of its stage (see observe), or a guess from
+    DEFAULT_PEAKS. A process may start if all the reservations fit in the
+    budget, and its own reservation fits in the memory that's available
+    right now (MemAvailable). If none of our processes are running,
+    the next one may start regardless.
+
+    The budget defaults to the memory available when the gate is created.
+
+    A make's peak RSS is that of its largest job. The make has one
+    reservation of that size for itself, and one for each additional job
+    it runs in parallel (see scheduler.MakeJobs).
+    """
+
+    def __init__(self, budget=None, *, counters=None):
+        if budget is None:
+            budget = read_meminfo().get('MemAvailable')
+        self.budget = budget
+        self.counters = collections.Counter() if counters is None else counters
+        self.peaks = {}
+        self.reserved = 0
+        self.running = 0
+        self.decisions = collections.deque(maxlen=100)
+        self._waiters = []  # [get_priority, seq, future, stage, size]
+        self._seq = itertools.count()
+
+    def estimate(self, stage):
+        return self.peaks.get(stage, DEFAULT_PEAKS.get(stage, 0))
+
+    def get_estimates(self):
+        return {stage: self.estimate(stage) for stage in DEFAULT_PEAKS}
+
+    def observe(self, stage, max_rss):
+        """Record the peak RSS of a finished process (None if unknown)"""
+        if max_rss and max_rss > self.peaks.get(stage, 0):
+            self.peaks[stage] = max_rss
+
+    @contextlib.asynccontextmanager
+    async def reservation(self, stage, build=None, *, priority=tuple):
+        """Hold a reservation for a process of the given stage
+
+        Waiters are admitted in order of priority (lowest first).
+        """
+        size = self.estimate(stage)
+        if self._waiters or not self._fits(size):
+            # _wake() makes the reservation for us
+            await self._wait(stage, build, size, priority)
+        else:
+            self._reserve(size)
+        try:
+            yield
+        finally:
+            self._release(size)
+
+    def _reserve(self, size):
+        self.reserved += size
+        self.running += 1
+
+    def _release(self, size):
+        self.reserved -= size
+        self.running -= 1
+        self._wake()
+
+    def _fits(self, size):
+        if self.budget is None or not self.running:
+            return True
+        if self.reserved + size > self.budget:
+            return False
+        available = read_meminfo().get('MemAvailable')
+        return available is None or size <= available
+
+    async def _wait(self, stage, build, size, priority):
+        start = time.monotonic()
+        self.counters['memory: processes held back'] += 1
+        self._record('held back', stage, build, size)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append([priority, next(self._seq), future, stage, size])
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(size)
+            else:
+                self._waiters = [
+                    w for w in self._waiters if w[2] is not future
+                ]
+                self._wake()
+            raise
+        waited = time.monotonic() - start
+        self.counters['memory: seconds held back'] += round(waited)
+        self._record('admitted', stage, build, size, waited=waited)
+
+    def _wake(self):
+        self._waiters.sort(key=lambda w: (w[0](), w[1]))
+        while self._waiters:
+            get_priority, seq, future, stage, size = self._waiters[0]
+            if future.cancelled():
+                self._waiters.pop(0)
+                continue
+            if not self._fits(size):
+                break
+            self._waiters.pop(0)
+            self._reserve(size)
+            future.set_result(None)
+
+    def _record(self, decision, stage, build, size, waited=None):
+        entry = dict(
+            time=time.time(),
+            decision=decision,
+            stage=stage,
+            build=None if build is None else build.tag,
+            size=size,
+            reserved=self.reserved,
+            budget=self.budget,
+            waited=waited,
+        )
+        self.decisions.append(entry)
+        if decision == 'held back':
+            print(
+                f'memory: holding back {stage} of {entry["build"]}:',
+                f'needs ~{size / 2**20:.0f}MB,',
+                f'{self.reserved / 2**20:.0f}MB reserved',
+                f'of {self.budget / 2**20:.0f}MB',
+            )
+
+    def format_usage(self):
+        if self.budget is None:
+            return ''
+        return (
+            f'mem:{self.reserved / 2**20:.0f}/{self.budget / 2**20:.0f}MB'
+            + (f'+{len(self._waiters)}' if self._waiters else '')
+        )
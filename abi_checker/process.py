@@ -0,0 +1,133 @@
+"""Running processes to completion, with their resource usage
+
+asyncio's subprocess support reaps children itself, so it can't report
+their rusage. Here, the exit is noticed through a pidfd and the child is
+reaped with os.wait4.
+
+Note that on Linux, ru_maxrss survives exec: a child's peak RSS is never
+reported lower than our own peak RSS when it was started. Such a report
+says nothing about the child, so it's left out (see run).
+"""
+
+import subprocess
+import resource
+import asyncio
+import types
+import os
+
+from .util import kill_process_group
+
+
+async def run(args, *, input=None, stdout=None, stderr=None, timeout=None,
+              **kwargs):
+    """Run a process in its own session; like Popen.communicate()
+
+    On timeout or cancellation, the whole process group is killed.
+    Returns a SimpleNamespace with returncode, stdout_data, stderr_data,
+    rusage, max_rss (peak RSS in bytes of the process or any of its
+    descendants, or None if it was no higher than what it inherited),
+    and timed_out.
+    """
+    loop = asyncio.get_running_loop()
+    inherited_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    proc = subprocess.Popen(
+        args,
+        stdin=None if input is None else subprocess.PIPE,
+        stdout=stdout,
+        stderr=stderr,
+        start_new_session=True,
+        **kwargs,
+    )
+    pidfd = os.pidfd_open(proc.pid)
+    exited = loop.create_future()
+    def on_exit():
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            loop.remove_reader(pidfd)
+            # Tell Popen the child is gone, so it doesn't try to reap it
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            exited.set_result(rusage)
+    loop.add_reader(pidfd, on_exit)
+    stdout_data = stderr_data = None
+    timed_out = False
+    try:
+        async with asyncio.timeout(timeout):
+            _, stdout_data, stderr_data = await asyncio.gather(
+                _write(proc.stdin, input),
+                _read(proc.stdout),
+                _read(proc.stderr),
+            )
+            rusage = await asyncio.shield(exited)
+    except TimeoutError:
+        timed_out = True
+    finally:
+        if not exited.done():
+            kill_process_group(proc.pid)
+            rusage = await exited
+        os.close(pidfd)
+    return types.SimpleNamespace(
+        returncode=proc.returncode,
+        stdout_data=stdout_data,
+        stderr_data=stderr_data,
+        rusage=rusage,
+        # ru_maxrss is in kilobytes on Linux
+        max_rss=(
+            rusage.ru_maxrss * 1024
+            if rusage.ru_maxrss > inherited_rss else None
+        ),
+        timed_out=timed_out,
+    )
+
+
+async def _read(pipe):
+    if pipe is None:
+        return None
+    loop = asyncio.get_running_loop()
+    fd = pipe.fileno()
+    os.set_blocking(fd, False)
+    chunks = []
+    eof = loop.create_future()
+    def on_readable():
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return
+        if data:
+            chunks.append(data)
+        else:
+            loop.remove_reader(fd)
+            eof.set_result(None)
+    loop.add_reader(fd, on_readable)
+    try:
+        await eof
+    finally:
+        loop.remove_reader(fd)
+        pipe.close()
+    return b''.join(chunks)
+
+
+async def _write(pipe, data):
+    if pipe is None:
+        return
+    loop = asyncio.get_running_loop()
+    fd = pipe.fileno()
+    os.set_blocking(fd, False)
+    data = memoryview(data)
+    done = loop.create_future()
+    def on_writable():
+        nonlocal data
+        try:
+            data = data[os.write(fd, data):]
+        except BlockingIOError:
+            return
+        except BrokenPipeError:
+            data = data[:0]
+        if not data:
+            loop.remove_writer(fd)
+            done.set_result(None)
+    loop.add_writer(fd, on_writable)
+    try:
+        await done
+    finally:
+        loop.remove_writer(fd)
+        pipe.close()
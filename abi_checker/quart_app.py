@@ -4,14 +4,16 @@ import asyncio
 import json
 import os
 
-from quart import Quart, render_template, url_for, websocket
+from quart import Quart, abort, render_template, url_for, websocket
 from jinja2 import StrictUndefined
 from markupsafe import Markup
 
 from .root import Root
 from .report import Report
 from .caserun import RunResult
+from .runresult import Expectation
 from .compileoptions import CompileOptions
+from . import cachegc
 
 class App(Quart):
     jinja_options = dict(
@@ -23,21 +25,36 @@ class App(Quart):
 app = App(__name__)
 
 def run_url(run):
+    return cell_url(
+        run.case, run.compile_build, run.compile_options, run.exec_build,
+    )
+
+def cell_url(case, compile_build, compile_opts, exec_build):
     return url_for(
         'run',
-        case=run.case.tag,
-        compile_build=run.compile_build.tag,
-        compile_opts=run.compile_options.tag,
-        exec_build=run.exec_build.tag,
+        case=case.tag,
+        compile_build=compile_build.tag,
+        compile_opts=compile_opts.tag,
+        exec_build=exec_build.tag,
     )
 
-def run_icon_url(run):
+def run_tag_url(tag):
+    case, compile_build, compile_opts, exec_build = tag.split('/')
+    return url_for(
+        'run',
+        case=case,
+        compile_build=compile_build,
+        compile_opts=compile_opts,
+        exec_build=exec_build,
+    )
+
+def cell_icon_url(case, compile_build, compile_opts, exec_build):
     return url_for(
         'run_icon',
-        case=run.case.tag,
-        compile_build=run.compile_build.tag,
-        compile_opts=run.compile_options.tag,
-        exec_build=run.exec_build.tag,
+        case=case.tag,
+        compile_build=compile_build.tag,
+        compile_opts=compile_opts.tag,
+        exec_build=exec_build.tag,
     )
 
 def case_url(case):
@@ -50,8 +67,11 @@ def case_url(case):
 def jinja_globals():
     return {
         'RunResult': RunResult,
+        'Expectation': Expectation,
         'run_url': run_url,
-        'run_icon_url': run_icon_url,
+        'cell_url': cell_url,
+        'run_tag_url': run_tag_url,
+        'cell_icon_url': cell_icon_url,
         'case_url': case_url,
         'asyncio': asyncio,
         'traceback': traceback,
@@ -76,53 +96,128 @@ def file_info(path):
 root = Root.from_env(os.environ)
 report = Report(root)
 
+@app.before_serving
+async def start_root():
+    root.start_repo_sync()
+    if root.refresh_interval:
+        task = asyncio.create_task(poll_refs(), name='poll_refs')
+        root.exit_stack.callback(task.cancel)
+    if root.cache_budget is not None:
+        start_cache_gc()
+
+def start_cache_gc():
+    """Trim the cache to ABI_CHECKER_CACHE_BUDGET in the background"""
+    async def gc():
+        try:
+            print(await cachegc.collect(
+                report, budget=root.cache_budget, live=True,
+            ))
+        except Exception:
+            traceback.print_exc()
+    task = asyncio.create_task(gc(), name='cache gc')
+    root.exit_stack.callback(task.cancel)
+
+async def poll_refs():
+    """Pick up new CPython releases without a restart (see Report.refresh)
+    """
+    while True:
+        await asyncio.sleep(root.refresh_interval)
+        try:
+            changed = await report.refresh()
+        except Exception:
+            traceback.print_exc()
+            continue
+        if changed:
+            print('refs changed:', *sorted(changed))
+            if root.cache_budget is not None:
+                # Builds of older releases may have dropped out
+                start_cache_gc()
+
+@app.after_serving
+async def close_root():
+    await root.aclose()
+
 @app.route('/')
 async def index():
-    report.get_runs()
+    # Runs start when their cells are shown (see spinners.js);
+    # optionally, all other runs fill in at low priority.
+    if root.background_runs:
+        report.start_runs()
     await asyncio.sleep(.01)
     return await render_template("report.html.jinja", report=report)
 
-@app.route('/runs/<case>/<compile_build>/<compile_opts>/<exec_build>/')
-async def run(case, compile_build, compile_opts, exec_build):
-    run = report.get_run(
+async def get_cell(case, compile_build, compile_opts, exec_build):
+    return (
         await report.get_case(case),
         await report.get_build(compile_build),
         CompileOptions.parse(compile_opts),
         await report.get_build(exec_build),
     )
-    return await render_template("run.html.jinja", run=run)
+
+@app.route('/runs/<case>/<compile_build>/<compile_opts>/<exec_build>/')
+async def run(case, compile_build, compile_opts, exec_build):
+    cell = await get_cell(case, compile_build, compile_opts, exec_build)
+    result = await report.request(*cell)
+    # The result & exception come from the matrix: a CaseRun that's not
+    # among the recent ones would compute them again
+    return await render_template(
+        "run.html.jinja",
+        run=report.get_run(*cell),
+        result=result,
+        exception=await report.get_error(*cell),
+    )
 
 @app.route('/runs/<case>/<compile_build>/<compile_opts>/<exec_build>/icon/')
 async def run_icon(case, compile_build, compile_opts, exec_build):
-    run = report.get_run(
-        await report.get_case(case),
-        await report.get_build(compile_build),
-        CompileOptions.parse(compile_opts),
-        await report.get_build(exec_build),
+    cell = await get_cell(case, compile_build, compile_opts, exec_build)
+    matrix = await report.get_matrix()
+    if matrix.find(*cell) is None:
+        # e.g. a build replaced by a refresh, or options it doesn't have
+        abort(404)
+    result = await report.request(*cell)
+    # The matrix may have been replaced meanwhile (see Report.refresh)
+    matrix = await report.get_matrix()
+    index = matrix.find(*cell)
+    return await render_template(
+        "run-icon.html.jinja",
+        cell=cell,
+        result=result,
+        message=None if index is None else matrix.get_message(index),
     )
-    return await render_template("run-icon.html.jinja", run=run)
 
 @app.route('/cases/<case>/')
 async def case(case):
     case = await report.get_case(case)
     return await render_template("case.html.jinja", case=case)
 
+@app.route('/layouts/')
+async def layouts():
+    return await render_template("layouts.html.jinja", report=report)
+
+@app.route('/stats/')
+async def stats():
+    return await render_template("stats.html.jinja", root=root)
+
+@app.route('/stats/trace.json')
+async def stats_trace():
+    # Load in https://ui.perfetto.dev or chrome://tracing
+    return root.tracer.chrome_trace()
+
 @app.websocket('/ws/')
 async def ws():
     cancelled = False
     async with asyncio.TaskGroup() as tg:
         while True:
             tag = await websocket.receive()
-            case, compile_build, compile_opts, exec_build = tag.split('/')
-            run = report.get_run(
-                await report.get_case(case),
-                await report.get_build(compile_build),
-                CompileOptions.parse(compile_opts),
-                await report.get_build(exec_build),
-            )
-            async def respond(run, tag):
+            try:
+                cell = await get_cell(*tag.split('/'))
+            except KeyError:
+                # e.g. the build's ref was removed (see Report.refresh)
+                await websocket.send(tag)
+                continue
+            async def respond(cell, tag):
                 try:
-                    await run.get_result()
+                    await report.request(*cell)
                 finally:
                     await websocket.send(tag)
-            tg.create_task(respond(run, tag))
+            tg.create_task(respond(cell, tag))
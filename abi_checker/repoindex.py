@@ -0,0 +1,167 @@
+import subprocess
+import asyncio
+import json
+import os
+import re
+
+from .util import cached_task
+from .pyversion import PyVersion
+
+readme_re = re.compile(rb"This is Python version (?P<version>[\.\da-z]+)")
+
+
+class RepoIndex:
+    """Batched access to the CPython source repository
+
+    All refs are resolved with a single `git for-each-ref`, and files are
+    read through one long-lived `git cat-file --batch` process.
+    Versions are cached on disk, keyed by commit OID (which never changes
+    meaning, so the cache needs no invalidation).
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._cat_file_lock = asyncio.Lock()
+        self._cat_file_tasks = set()
+        self._versions_path = root.cache_dir / 'versions.json'
+        try:
+            self._versions = json.loads(self._versions_path.read_text())
+        except FileNotFoundError:
+            self._versions = {}
+
+    @cached_task
+    async def get_refs(self):
+        """Map ref names to commit hashes
+
+        Each ref is included under its full name (refs/tags/v3.12.0) and
+        short name (v3.12.0), with tags taking precedence over branches
+        like in `git rev-parse`.
+        """
+        refs = await read_refs(self.root, self.root.cpython_dir)
+        short_names = {}
+        for refname, oid in list(refs.items()):
+            for priority, prefix in enumerate((
+                'refs/remotes/', 'refs/heads/', 'refs/tags/',
+            )):
+                if refname.startswith(prefix):
+                    short_name = refname.removeprefix(prefix)
+                    short_names.setdefault(short_name, []).append(
+                        (priority, oid),
+                    )
+        for short_name, candidates in short_names.items():
+            refs.setdefault(short_name, max(candidates)[1])
+        return refs
+
+    async def refresh(self):
+        """Re-read the refs; return names of refs added, moved or removed"""
+        old_refs = await self.get_refs()
+        RepoIndex.get_refs.invalidate(self)
+        new_refs = await self.get_refs()
+        return {
+            name for name in old_refs.keys() | new_refs.keys()
+            if old_refs.get(name) != new_refs.get(name)
+        }
+
+    async def get_tag_names(self):
+        return [
+            refname.removeprefix('refs/tags/')
+            for refname in await self.get_refs()
+            if refname.startswith('refs/tags/')
+        ]
+
+    async def read_file(self, commit_hash, path):
+        """Get the contents of a file in a commit, or None if it's missing"""
+        cat_file = await self._get_cat_file()
+        # If we're cancelled between the request and reading the reply,
+        # the reply would be read as the answer to the next request.
+        # So the exchange runs in its own task, which always completes.
+        task = asyncio.create_task(
+            self._cat_file_exchange(cat_file, f'{commit_hash}:{path}'),
+        )
+        self._cat_file_tasks.add(task)
+        task.add_done_callback(self._cat_file_tasks.discard)
+        objtype, data = await asyncio.shield(task)
+        if objtype != b'blob':
+            return None
+        return data
+
+    async def _cat_file_exchange(self, cat_file, request):
+        """Send a request to `git cat-file`; return (objtype, contents)
+
+        objtype is None if the object is missing.
+        """
+        async with self._cat_file_lock:
+            cat_file.stdin.write(f'{request}\n'.encode())
+            await cat_file.stdin.drain()
+            header = await cat_file.stdout.readline()
+            if not header:
+                raise RuntimeError('git cat-file exited unexpectedly')
+            oid, objtype, *size = header.split()
+            if not size:
+                # `<object> missing` (or ambiguous)
+                return None, None
+            data = await cat_file.stdout.readexactly(int(size[0]) + 1)
+        return objtype, data[:-1]
+
+    @cached_task
+    async def _get_cat_file(self):
+        proc = await asyncio.create_subprocess_exec(
+            'git', 'cat-file', '--batch',
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=self.root.cpython_dir,
+        )
+        async def close():
+            proc.stdin.close()
+            await proc.wait()
+        self.root.exit_stack.push_async_callback(close)
+        return proc
+
+    async def get_version(self, commit_hash):
+        """Get the Python version of a commit, as given in its README"""
+        try:
+            return PyVersion.parse(self._versions[commit_hash])
+        except KeyError:
+            pass
+        for name in 'README.rst', 'README':
+            content = await self.read_file(commit_hash, name)
+            if content is not None:
+                break
+        else:
+            raise LookupError(f'README not found in commit {commit_hash}')
+        firstline, sep, rest = content.partition(b'\n')
+        match = readme_re.match(firstline)
+        version = PyVersion.parse(match['version'].decode())
+        self._versions[commit_hash] = str(version)
+        self._save_versions()
+        return version
+
+    def _save_versions(self):
+        path = self._versions_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+        tmp.write_text(json.dumps(self._versions, indent=0, sort_keys=True))
+        os.replace(tmp, path)
+
+
+async def read_refs(root, git_dir, *patterns):
+    """Map full ref names to the commits they point to (peeling tags)
+
+    Refs that don't point to commits are left out.
+    """
+    proc = await root.run_process(
+        'git', 'for-each-ref',
+        '--format=%(objectname)%09%(objecttype)%09'
+            + '%(*objectname)%09%(*objecttype)%09%(refname)',
+        *patterns,
+        stdout=subprocess.PIPE,
+        cwd=git_dir,
+    )
+    refs = {}
+    for line in proc.stdout_data.decode().splitlines():
+        oid, objtype, peeled, peeled_type, refname = line.split('\t')
+        if peeled:
+            oid, objtype = peeled, peeled_type
+        if objtype == 'commit':
+            refs[refname] = oid
+    return refs
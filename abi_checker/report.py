@@ -1,24 +1,36 @@
 from functools import cached_property
 import collections
 import asyncio
+import json
+import os
 
 from .case import Cases
-from .util import cached_task
+from .util import cached_task, touch
 from .build import Build
-from .errors import SkipBuild
+from .errors import SkipBuild, ExpectFailure
 from .commit import CPythonCommit, get_tagged_commits
-from .caserun import CaseRun
+from .caserun import CaseRun, get_expectation, get_store_key
+from .matrix import ResultMatrix
+from .runresult import Expectation
+from .layout import LayoutProbe
 from .feature import _FEATURES
 from .pyversion import PyVersion
 
+# Number of CaseRuns kept around after they're used (see get_run)
+RECENT_RUNS = 256
+
 
 class Report:
     def __init__(self, root, *, commits=None):
         self.root = root
         self._commits = commits
         self._builddict = None
+        self._matrix = None
         self._cases = Cases(self.root)
-        self._rundict = {}
+        self._runs_in_flight = {}
+        self._build_tasks = {}
+        self._recent_runs = collections.OrderedDict()
+        self._layout_probes = {}
 
     @cached_task
     async def get_commits(self):
@@ -32,19 +44,20 @@ class Report:
 
     @cached_task
     async def get_builds(self):
-        if self._builddict is not None:
-            return list(self._builddict.values())
         commits = await self.get_commits()
-        self._builddict = {}
+        # Keep Build objects from before a refresh (see refresh())
+        old_builds = self._builddict or {}
+        old_commits = {b.commit.name: b.commit for b in old_builds.values()}
         tasks = []
         async with asyncio.TaskGroup() as tg:
             for commit in commits:
+                commit = old_commits.get(commit.name, commit)
                 if (await commit.get_version()) < PyVersion.pack(3, 5):
                     continue
                 for feature in (None, *_FEATURES.values()):
                     features = (feature,) if feature else ()
                     tasks.append(tg.create_task(_make_build(
-                        self.root, commit, features,
+                        self.root, commit, features, old_builds,
                     )))
         builds = [(await t) for t in tasks]
         self._builddict = {b.tag: b for b in builds if b}
@@ -80,32 +93,378 @@ class Report:
         return self._cases[name]
 
     @cached_task
-    async def get_runs(self):
-        cases = await self.get_cases()
-        _runs = []
+    async def get_build_order(self):
+        """Order builds so that the first ones complete the most results
+
+        Each cell of the result matrix needs its compile build and its
+        exec build. Greedily pick the build that completes the most cells
+        together with the builds already picked (then, the build used in
+        the most cells overall).
+        """
+        n_cases = len(await self.get_cases())
+        # shared[a][b]: cells that need builds a and b (a != b)
+        shared = collections.defaultdict(collections.Counter)
+        # Cells that need a single build, then gains as builds are picked
+        gains = collections.Counter()
+        totals = collections.Counter()
+        for comp_build in await self.get_compile_builds():
+            n_opts = len(await comp_build.get_possible_compile_options())
+            for exec_build in await self.get_exec_builds():
+                comp_tag, exec_tag = comp_build.tag, exec_build.tag
+                n = n_opts * n_cases
+                if comp_tag == exec_tag:
+                    gains[comp_tag] += n
+                else:
+                    shared[comp_tag][exec_tag] += n
+                    shared[exec_tag][comp_tag] += n
+                totals[comp_tag] += n
+                totals[exec_tag] += n
+        remaining = {b.tag: b for b in await self.get_builds()}
+        result = []
+        while remaining:
+            tag = max(remaining, key=lambda tag: (gains[tag], totals[tag]))
+            result.append(remaining.pop(tag))
+            for other, n in shared[tag].items():
+                gains[other] += n
+        return result
+
+    @cached_task
+    async def get_matrix(self):
+        """Get the ResultMatrix, with results filled in as they come
+
+        Also ranks the builds for the scheduler (see get_build_order).
+        After a refresh, results are copied from the previous matrix.
+        """
+        self.root.scheduler.rank_builds(await self.get_build_order())
+        rows = [
+            (build, opts)
+            for build in await self.get_compile_builds()
+            for opts in await build.get_possible_compile_options()
+        ]
+        matrix = ResultMatrix(
+            await self.get_cases(), rows, await self.get_exec_builds(),
+        )
+        if self._matrix is not None:
+            matrix.copy_results(self._matrix)
+        self._matrix = matrix
+        return matrix
+
+    async def refresh(self):
+        """Pick up refs that were added, moved or removed in cpython_dir
+
+        Builds (and results) of commits whose refs didn't change are kept;
+        the cached tasks that depend on the set of builds are recomputed.
+        Until the new matrix is ready, the old one is still served.
+        Returns the names of the changed refs.
+        """
+        changed = await self.root.refresh_refs()
+        if not changed:
+            return changed
+        if self._commits is not None:
+            self._commits = [
+                CPythonCommit(self.root, c.name) if c.name in changed else c
+                for c in self._commits
+            ]
+        if self._builddict is not None:
+            self._builddict = {
+                tag: build for tag, build in self._builddict.items()
+                if build.commit.name not in changed
+            }
+        self._build_tasks = {
+            tag: task for tag, task in self._build_tasks.items()
+            if tag.partition('~')[0] not in changed
+        }
+        self._layout_probes = {
+            (build, opts): probe
+            for (build, opts), probe in self._layout_probes.items()
+            if build.commit.name not in changed
+        }
+        self._recent_runs.clear()
+        for task in (
+            Report.get_commits, Report.get_builds,
+            Report.get_compile_builds, Report.get_exec_builds,
+            Report.get_possible_compile_options, Report.get_build_order,
+            Report.get_layout_classes,
+        ):
+            task.invalidate(self)
+        # Get what the new matrix needs before dropping the old one
+        await self.get_build_order()
+        Report.get_matrix.invalidate(self)
+        await self.get_matrix()
+        background = Report.compute_all.invalidate(self)
+        if background is not None:
+            background.cancel()
+            self.start_runs()
+        return changed
+
+    async def get_expectations(self, case):
+        """Get the matrix, with Expectations for all of a case's cells
+
+        This only needs the commits' versions, so it doesn't wait
+        for any builds.
+        """
+        matrix = await self.get_matrix()
+        if matrix.has_expectations(case):
+            return matrix
+        versions = {}
+        features = {}
+        for build in (*(b for b, o in matrix.rows), *matrix.exec_builds):
+            if build.tag not in versions:
+                versions[build.tag] = await build.commit.get_version()
+                features[build.tag] = tuple(f.tag for f in build.features)
+        expectations = []
+        for compile_build, compile_options in matrix.rows:
+            for exec_build in matrix.exec_builds:
+                exception = get_expectation(
+                    case,
+                    versions[compile_build.tag], versions[exec_build.tag],
+                    features[compile_build.tag], features[exec_build.tag],
+                    compile_options,
+                )
+                if exception is None:
+                    expectations.append(Expectation.WORKS)
+                elif isinstance(exception, ExpectFailure):
+                    expectations.append(Expectation.FAILS)
+                else:
+                    expectations.append(Expectation.SKIPPED)
+        matrix.set_expectations(case, expectations)
+        return matrix
+
+    async def get_result(self, case, compile_build, compile_options, exec_build):
+        """Get the result of a cell, computing it if needed"""
+        matrix = await self.get_matrix()
+        index = matrix.find(case, compile_build, compile_options, exec_build)
+        if index is not None:
+            result = matrix.get(index)
+            if result is not None:
+                return result
+        run, task = self._start_run(
+            case, compile_build, compile_options, exec_build,
+        )
+        return await asyncio.shield(task)
+
+    def _start_run(self, *cell):
+        """Get (run, task) for a cell that's being computed, or start it"""
+        key = _get_key(*cell)
+        run = self._get_run_in_flight(key, *cell)
+        if run is not None:
+            return self._runs_in_flight[key]
+        run = self.get_run(*cell)
+        task = asyncio.create_task(
+            self._finish_run(key, run),
+            name=f'result of {run!r}',
+        )
+        self._runs_in_flight[key] = run, task
+        return run, task
+
+    def _get_run_in_flight(
+        self, key, case, compile_build, compile_options, exec_build,
+    ):
+        try:
+            run, task = self._runs_in_flight[key]
+        except KeyError:
+            return None
+        # After a ref moved, a run for its old build may still be going
+        if run.compile_build is compile_build and run.exec_build is exec_build:
+            return run
+        return None
+
+    async def _finish_run(self, key, run):
+        try:
+            result = await run.get_result()
+            # The matrix may have been replaced (see refresh)
+            matrix = self._matrix
+            index = matrix.find(
+                run.case, run.compile_build, run.compile_options,
+                run.exec_build,
+            )
+            if index is not None:
+                matrix.set(index, result, run.exception)
+        finally:
+            if self._runs_in_flight.get(key, (None,))[0] is run:
+                del self._runs_in_flight[key]
+        return result
+
+    @cached_task
+    async def compute_all(self):
+        """Compute all results (see compute_cells)"""
+        await self.compute_cells()
+
+    async def compute_cells(self, *, on_result=None, concurrency=None):
+        """Compute all results; call on_result(index, result) for each
+
+        `index` is the cell's index in the matrix.
+
+        Cells that the first builds (see get_build_order) complete go
+        first. Builds that some cell needs (one without a stored result)
+        are started right away so they can run in parallel, but only
+        `concurrency` runs are in flight at a time.
+        """
+        matrix = await self.get_matrix()
+        build_order = await self.get_build_order()
+        needed_tags = await self._get_needed_build_tags(matrix)
+        for build in build_order:
+            if build.tag not in needed_tags:
+                continue
+            self._build_tasks.setdefault(build.tag, asyncio.create_task(
+                _start_build(build), name=f'start of {build}',
+            ))
+        ranks = {b.tag: i for i, b in enumerate(build_order)}
+        def rank(index):
+            case, compile_build, compile_options, exec_build = (
+                matrix.get_cell(index)
+            )
+            return max(ranks[compile_build.tag], ranks[exec_build.tag])
+        indices = iter(sorted(range(len(matrix)), key=rank))
+        async def worker():
+            for index in indices:
+                result = matrix.get(index)
+                if result is None:
+                    run, task = self._start_run(*matrix.get_cell(index))
+                    result = await asyncio.shield(task)
+                if on_result is not None:
+                    on_result(index, result)
+        if concurrency is None:
+            concurrency = 16 * (self.root.jobs or os.process_cpu_count() or 1)
         async with asyncio.TaskGroup() as tg:
-            for comp_build in await self.get_compile_builds():
-                for comp_opts in await comp_build.get_possible_compile_options():
-                    for run_build in await self.get_exec_builds():
-                        for case in cases:
-                            run = self.get_run(
-                                case, comp_build, comp_opts, run_build)
-                            _runs.append(run)
-                            tg.create_task(run.get_result())
-        return _runs
-
-    def get_run(self, *args):
+            for i in range(concurrency):
+                tg.create_task(worker())
+
+    async def _get_needed_build_tags(self, matrix):
+        """Tags of builds that cells without a stored result need"""
+        needed_tags = set()
+        for index in range(len(matrix)):
+            if matrix.get(index) is not None:
+                continue
+            case, compile_build, compile_options, exec_build = (
+                matrix.get_cell(index)
+            )
+            if {compile_build.tag, exec_build.tag} <= needed_tags:
+                continue
+            await self.get_expectations(case)
+            if matrix.get_expectation(index) == Expectation.SKIPPED:
+                continue
+            if self.root.reuse_results:
+                key = await get_store_key(
+                    case, compile_build, compile_options, exec_build,
+                )
+                if await self.root.result_store.contains(key):
+                    continue
+            needed_tags.update((compile_build.tag, exec_build.tag))
+        return needed_tags
+
+    def start_runs(self):
+        """Start computing all results in the background"""
+        return self.compute_all.task
+
+    async def request(self, case, compile_build, compile_options, exec_build):
+        """Get a cell's result, ahead of cells nobody asked for
+
+        The builds the run needs are prioritized until the result is done.
+        """
+        with self.root.scheduler.boosting(compile_build, exec_build):
+            return await self.get_result(
+                case, compile_build, compile_options, exec_build,
+            )
+
+    async def get_error(self, case, compile_build, compile_options, exec_build):
+        """Get the exception of a cell with the ERROR result, or None
+
+        Unlike the CaseRun, the matrix keeps it for as long as the result.
+        """
+        matrix = await self.get_matrix()
+        index = matrix.find(case, compile_build, compile_options, exec_build)
+        if index is None:
+            return None
+        return matrix.errors.get(index)
+
+    def get_layout_probe(self, build, compile_options):
+        key = build, compile_options
         try:
-            return self._rundict[args]
+            return self._layout_probes[key]
         except KeyError:
-            run = CaseRun.create(*args)
-            self._rundict[args] = run
-            run.get_result
+            probe = LayoutProbe(build, compile_options)
+            self._layout_probes[key] = probe
+            return probe
+
+    @cached_task
+    async def get_layout_classes(self):
+        """Group compile builds & options by the struct layouts they see
+
+        Returns a list of (layout, [(build, compile_options), ...]),
+        with layout None for probes that failed.
+        """
+        probes = [
+            self.get_layout_probe(build, opts)
+            for build in await self.get_compile_builds()
+            for opts in await build.get_possible_compile_options()
+        ]
+        # get_layout gives None on failure; in any case, one failing probe
+        # shouldn't cancel the others
+        layouts = await asyncio.gather(
+            *(probe.get_layout() for probe in probes),
+            return_exceptions=True,
+        )
+        classes = {}
+        for probe, layout in zip(probes, layouts):
+            if isinstance(layout, Exception):
+                layout = None
+            key = json.dumps(layout, sort_keys=True)
+            classes.setdefault(key, (layout, []))[1].append(
+                (probe.build, probe.compile_options),
+            )
+        return list(classes.values())
+
+    def get_run(self, case, compile_build, compile_options, exec_build):
+        """Get a CaseRun for a cell, e.g. to show its details
+
+        CaseRuns are only kept while they're computing a result, and for
+        a few recently used cells. Otherwise, a new one is made.
+        It's not started until its result is requested.
+        """
+        key = _get_key(case, compile_build, compile_options, exec_build)
+        run = self._get_run_in_flight(
+            key, case, compile_build, compile_options, exec_build,
+        )
+        if run is not None:
             return run
+        try:
+            run = self._recent_runs.pop(key)
+        except KeyError:
+            run = CaseRun.create(
+                case, compile_build, compile_options, exec_build,
+            )
+        else:
+            # The run's files (runs/CASE/BUILD; see cachegc) are used
+            # again, without going through the caches that touch them
+            touch(run.test_module.path)
+        self._recent_runs[key] = run
+        while len(self._recent_runs) > RECENT_RUNS:
+            self._recent_runs.popitem(last=False)
+        return run
+
+
+def _get_key(case, compile_build, compile_options, exec_build):
+    return case.tag, compile_build.tag, compile_options.tag, exec_build.tag
+
+
+async def _start_build(build):
+    """Build ahead of the runs that will need it
+
+    Errors are left for those runs to report.
+    """
+    try:
+        await build.get_executable()
+    except Exception:
+        pass
 
 
-async def _make_build(root, commit, features):
+async def _make_build(root, commit, features, old_builds):
     build = Build(root, commit, features)
+    try:
+        return old_builds[build.tag]
+    except KeyError:
+        pass
     for feature in features:
         try:
             await feature.verify_compatibility(build)
@@ -0,0 +1,151 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import sqlite3
+import asyncio
+import time
+import zlib
+
+from .runresult import RunResult
+
+# Seconds to wait for more results before committing, so that results
+# finishing around the same time share a commit
+COMMIT_DELAY = 1
+
+
+class ResultStore:
+    """Persistent index of CaseRun results, keyed by a digest of the inputs
+
+    The logs of the run that produced a result are stored with it
+    (zlib-compressed), so they can be shown for reused results.
+
+    Queries run in a thread of their own, so waiting for the database
+    (e.g. for another process's commit) doesn't block the event loop.
+    Results are committed in batches, shortly after they're put.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._executor = ThreadPoolExecutor(
+            1, thread_name_prefix='result store',
+        )
+        self._db = None  # only used in the executor's thread
+        self._pending = {}  # key: (result, logs) not committed yet
+        self._commit_task = None
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args,
+        )
+
+    def _get_db(self):
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    result TEXT NOT NULL,
+                    stored REAL NOT NULL
+                )
+            """)
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS logs (
+                    key TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (key, name)
+                )
+            """)
+            self._db = db
+        return self._db
+
+    async def contains(self, key):
+        if key in self._pending:
+            return True
+        return await self._call(self._contains, key)
+
+    def _contains(self, key):
+        row = self._get_db().execute(
+            'SELECT 1 FROM results WHERE key = ?', (key,),
+        ).fetchone()
+        return row is not None
+
+    async def get(self, key):
+        """Get (RunResult, {log name: contents}), or None if not stored"""
+        try:
+            return self._pending[key]
+        except KeyError:
+            return await self._call(self._get, key)
+
+    def _get(self, key):
+        db = self._get_db()
+        row = db.execute(
+            'SELECT result FROM results WHERE key = ?', (key,),
+        ).fetchone()
+        if row is None:
+            return None
+        logs = {
+            name: zlib.decompress(data)
+            for name, data in db.execute(
+                'SELECT name, data FROM logs WHERE key = ?', (key,),
+            )
+        }
+        return RunResult(row[0]), logs
+
+    def put(self, key, result, logs):
+        """Store a result; it's committed soon, with others"""
+        self._pending[key] = result, logs
+        if self._commit_task is None:
+            self._commit_task = asyncio.create_task(
+                self._commit_pending(), name='result store commit',
+            )
+
+    async def _commit_pending(self):
+        try:
+            while self._pending:
+                await asyncio.sleep(COMMIT_DELAY)
+                await self._commit(dict(self._pending))
+        finally:
+            self._commit_task = None
+
+    async def _commit(self, batch):
+        await self._call(self._write, batch)
+        for key, value in batch.items():
+            # (unless it was put again meanwhile)
+            if self._pending.get(key) is value:
+                del self._pending[key]
+
+    def _write(self, batch):
+        db = self._get_db()
+        with db:
+            db.execute('BEGIN')
+            for key, (result, logs) in batch.items():
+                db.execute(
+                    'INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                    (key, result.value, time.time()),
+                )
+                db.execute('DELETE FROM logs WHERE key = ?', (key,))
+                db.executemany(
+                    'INSERT INTO logs VALUES (?, ?, ?)',
+                    [
+                        (key, name, zlib.compress(data))
+                        for name, data in logs.items()
+                    ],
+                )
+
+    async def aclose(self):
+        """Commit what's pending, and close the database"""
+        if self._commit_task is not None:
+            self._commit_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._commit_task
+        if self._pending:
+            await self._commit(dict(self._pending))
+        await self._call(self._close)
+        self._executor.shutdown()
+
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -1,14 +1,29 @@
-from functools import cached_property
+from functools import cached_property, partial
 from pathlib import Path
 import collections
 import dataclasses
 import contextlib
+import hashlib
 import asyncio
-import types
+import shlex
 import os
+import re
 
-from .util import cached_task
+from .util import cached_task, set_rlimits
+from .util import parse_size, parse_timeouts
 from .feature import _FEATURES
+from .errors import ProcessTimeout
+from .trace import Tracer, RECENT_SPANS
+from . import process
+from .resultstore import ResultStore
+from .artifactcache import ArtifactCache
+from .jobserver import JobServer
+from .scheduler import Scheduler
+from .memory import MemoryGate
+from .buildcache import ConfigCache, get_ccache_stats
+from .repoindex import RepoIndex, read_refs
+from .blobstore import BlobStore
+from .logstore import LogStore
 
 
 @dataclasses.dataclass
@@ -16,6 +31,23 @@ class Root:
     cpython_dir: Path
     cache_dir: Path
     case_dir: Path
+    reuse_results: bool = True
+    exec_engine: str = 'spawn'
+    jobs: int | None = None
+    seed_builds: bool = False
+    config_cache: bool = False
+    ccache: bool = False
+    dedup_worktrees: bool = False
+    drop_worktree_sources: bool = False
+    pack_logs: bool = False
+    background_runs: bool = False
+    skip_predicted_failures: bool = False
+    timeouts: dict = dataclasses.field(default_factory=dict)
+    exec_rlimits: dict = dataclasses.field(default_factory=dict)
+    memory_budget: int | None = None
+    refresh_interval: float | None = None
+    cache_budget: int | None = None
+    trace_spans: int | None = 0
 
     @classmethod
     def from_args(cls, args):
@@ -23,6 +55,27 @@ class Root:
             cpython_dir=Path(args.cpython_dir).resolve(),
             cache_dir=Path(args.cache_dir).resolve(),
             case_dir=Path(args.case_dir).resolve(),
+            reuse_results=not args.rerun,
+            exec_engine=args.exec_engine,
+            jobs=args.jobs,
+            seed_builds=args.seed_builds,
+            config_cache=args.config_cache,
+            ccache=args.ccache,
+            dedup_worktrees=args.dedup_worktrees,
+            drop_worktree_sources=args.drop_worktree_sources,
+            pack_logs=args.pack_logs,
+            skip_predicted_failures=args.skip_predicted_failures,
+            timeouts={
+                stage: seconds
+                for timeouts in args.timeout or ()
+                for stage, seconds in timeouts.items()
+            },
+            exec_rlimits=_get_exec_rlimits(
+                args.exec_memory_limit, args.exec_cpu_limit,
+            ),
+            memory_budget=args.memory_budget,
+            cache_budget=args.cache_budget,
+            trace_spans=None if args.trace else 0,
         )
 
     @classmethod
@@ -31,41 +84,250 @@ class Root:
             cpython_dir=Path(env['CPYTHON_DIR']).resolve(),
             cache_dir=Path('.cache').resolve(),
             case_dir=Path(__file__, '../cases').resolve(),
+            exec_engine=env.get('ABI_CHECKER_EXEC_ENGINE', 'spawn'),
+            jobs=int(env.get('ABI_CHECKER_JOBS', 0)) or None,
+            seed_builds=bool(env.get('ABI_CHECKER_SEED_BUILDS')),
+            config_cache=bool(env.get('ABI_CHECKER_CONFIG_CACHE')),
+            ccache=bool(env.get('ABI_CHECKER_CCACHE')),
+            dedup_worktrees=bool(env.get('ABI_CHECKER_DEDUP_WORKTREES')),
+            drop_worktree_sources=bool(
+                env.get('ABI_CHECKER_DROP_WORKTREE_SOURCES'),
+            ),
+            pack_logs=bool(env.get('ABI_CHECKER_PACK_LOGS')),
+            background_runs=bool(env.get('ABI_CHECKER_BACKGROUND_RUNS')),
+            skip_predicted_failures=bool(
+                env.get('ABI_CHECKER_SKIP_PREDICTED_FAILURES'),
+            ),
+            timeouts=parse_timeouts(env.get('ABI_CHECKER_TIMEOUTS', '')),
+            exec_rlimits=_get_exec_rlimits(
+                parse_size(env['ABI_CHECKER_EXEC_MEMORY_LIMIT'])
+                if env.get('ABI_CHECKER_EXEC_MEMORY_LIMIT') else None,
+                int(env.get('ABI_CHECKER_EXEC_CPU_LIMIT', 0)) or None,
+            ),
+            memory_budget=(
+                parse_size(env['ABI_CHECKER_MEMORY_BUDGET'])
+                if env.get('ABI_CHECKER_MEMORY_BUDGET') else None
+            ),
+            refresh_interval=(
+                float(env.get('ABI_CHECKER_REFRESH_INTERVAL', 0)) or None
+            ),
+            cache_budget=(
+                parse_size(env['ABI_CHECKER_CACHE_BUDGET'])
+                if env.get('ABI_CHECKER_CACHE_BUDGET') else None
+            ),
+            trace_spans=RECENT_SPANS,
         )
 
     @cached_property
-    def process_semaphore(self):
-        return asyncio.Semaphore((os.process_cpu_count() or 0) + 2)
+    def jobserver(self):
+        """Limits the number of CPUs used by all processes we start"""
+        server = JobServer(self.jobs or os.process_cpu_count() or 1)
+        self.exit_stack.callback(server.close)
+        return server
+
+    @cached_property
+    def scheduler(self):
+        return Scheduler(self.jobserver, self.memory_gate)
+
+    @cached_property
+    def memory_gate(self):
+        """Limits the memory expected to be used by processes we start"""
+        return MemoryGate(self.memory_budget, counters=self.counters)
+
+    @cached_property
+    def tracer(self):
+        """Timing of processes & tasks (see trace.py)
+
+        Only totals are kept, and the last `trace_spans` spans
+        (all of them if that's None).
+        """
+        return Tracer(self.trace_spans)
+
+    @cached_property
+    def exit_stack(self):
+        """Cleanup callbacks for long-lived helpers (see aclose)"""
+        return contextlib.AsyncExitStack()
+
+    async def aclose(self):
+        await self.exit_stack.aclose()
 
     @cached_property
     def _builds(self):
         return {}
 
+    @cached_property
+    def log_store(self):
+        """Logs of runs; written there with pack_logs, else under runs/"""
+        return LogStore(self.cache_dir)
+
+    @cached_property
+    def blob_store(self):
+        return BlobStore(self)
+
+    @cached_property
+    def repo_index(self):
+        return RepoIndex(self)
+
+    @cached_property
+    def counters(self):
+        """Statistics (e.g. cache hits & misses) reported after a run"""
+        return collections.Counter()
+
+    @cached_property
+    def _config_caches(self):
+        return {}
+
+    def get_config_cache(self, features, configure_path):
+        """Get the shared config.cache for the default compiler, features
+        and configure script
+
+        Different configure scripts (e.g. of different CPython versions)
+        can run different checks under the same cache variable, so each
+        gets its own cache.
+        """
+        name = re.sub(r'[^\w.+-]', '_', os.environ.get('CC', 'cc'))
+        for feature in features:
+            name += '~' + feature.tag
+        with open(configure_path, 'rb') as f:
+            name += '-' + hashlib.file_digest(f, 'sha256').hexdigest()[:16]
+        try:
+            return self._config_caches[name]
+        except KeyError:
+            path = self.cache_dir / 'config-cache' / f'{name}.cache'
+            cache = self._config_caches[name] = ConfigCache(path)
+            return cache
+
+    @cached_task
+    async def get_ccache_baseline(self):
+        """ccache statistics from before our first build"""
+        return await get_ccache_stats(self)
+
+    async def get_ccache_delta(self):
+        """ccache statistics for this run, or None"""
+        if 'get_ccache_baseline' not in self.__dict__:
+            return None
+        before = await self.get_ccache_baseline()
+        after = await get_ccache_stats(self)
+        if before is None or after is None:
+            return None
+        return {
+            name: value - before.get(name, 0)
+            for name, value in after.items()
+            if value != before.get(name, 0)
+        }
+
+    @cached_property
+    def result_store(self):
+        store = ResultStore(self.cache_dir / 'results.sqlite3')
+        self.exit_stack.push_async_callback(store.aclose)
+        return store
+
+    @cached_property
+    def module_cache(self):
+        return ArtifactCache(self.cache_dir / 'modules')
+
+    @cached_property
+    def exec_cache(self):
+        return ArtifactCache(
+            self.cache_dir / 'execs',
+            reuse_existing=self.reuse_results,
+        )
+
     @cached_task
     async def get_cloned_repo(self):
+        """Get a bare mirror of cpython_dir, cloning it if needed
+
+        The mirror is a partial clone: file contents are only fetched when
+        a commit is checked out. It may be out of date; see get_synced_repo.
+        """
         repo_dir = self.cache_dir / 'cpython.git'
         repo_dir.parent.mkdir(parents=True, exist_ok=True)
-        if repo_dir.exists():
+        if not repo_dir.exists():
+            # The source is a local repo, which normally doesn't serve
+            # partial clones; use an upload-pack that does, also for
+            # later fetches (including fetches of missing blobs).
+            upload_pack = 'git -c uploadpack.allowFilter=true upload-pack'
             await self.run_process(
-                'git', 'fetch', 'origin',
-                cwd=repo_dir,
+                'git', 'clone', '--bare', '--filter=blob:none',
+                '--upload-pack', upload_pack,
+                '--config', f'remote.origin.uploadpack={upload_pack}',
+                '--', Path(self.cpython_dir).resolve().as_uri(), repo_dir,
             )
-        else:
+        return repo_dir
+
+    @cached_task
+    async def get_synced_repo(self):
+        """Get the mirror, after fetching any refs that changed in cpython_dir
+
+        Comparing refs is cheap, so the fetch only runs if there's
+        something new. This starts in the background (start_repo_sync);
+        only checkouts that miss the cache need to wait for it.
+        """
+        repo_dir = await self.get_cloned_repo()
+        patterns = 'refs/heads/', 'refs/tags/'
+        source_refs = {
+            refname: oid
+            for refname, oid in (await self.repo_index.get_refs()).items()
+            if refname.startswith(patterns)
+        }
+        if source_refs != await read_refs(self, repo_dir, *patterns):
             await self.run_process(
-                'git', 'clone',
-                '--bare',
-                '--', self.cpython_dir, repo_dir,
+                'git', 'fetch', '--prune', 'origin',
+                '+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*',
+                cwd=repo_dir,
             )
-
         return repo_dir
 
+    def start_repo_sync(self):
+        """Start get_synced_repo in the background"""
+        return self.get_synced_repo.task
+
+    async def refresh_refs(self):
+        """Re-read the refs of cpython_dir; return names of changed refs
+
+        If any changed, the mirror is synced again (in the background).
+        """
+        changed = await self.repo_index.refresh()
+        if changed:
+            previous_sync = Root.get_synced_repo.invalidate(self)
+            if previous_sync is not None:
+                # Don't run two fetches in the mirror at once
+                await asyncio.wait([previous_sync])
+            self.start_repo_sync()
+        return changed
+
     async def run_process(
         self, *args, check=True, input=None, stdout=None, stderr=None,
-        **kwargs
+        make=False, stage='other', build=None, case=None, timeout=None,
+        rlimits=None, **kwargs
     ):
+        """Run a process while holding a memory reservation & jobserver token
+
+        With make=True, the process (make) gets a jobserver of its own,
+        with additional tokens (and memory) lent to it for its parallel
+        jobs (see MakeJobs).
+        stage & build determine when the process may start; see Scheduler.
+
+        The process runs in its own session. If it doesn't finish in
+        `timeout` seconds (default: the stage's timeout), or if we're
+        cancelled, its whole process group is killed. On timeout,
+        ProcessTimeout is raised.
+        rlimits are resource limits for the process (see set_rlimits).
+
+        The run is recorded in the tracer, along with its CPU time and
+        peak memory.
+        """
+        if timeout is None:
+            timeout = self.get_timeout(stage)
+        if rlimits:
+            kwargs['preexec_fn'] = partial(set_rlimits, rlimits)
         stdout_path = stderr_path = None
         async with contextlib.AsyncExitStack() as cm:
-            await cm.enter_async_context(self.process_semaphore)
+            make_jobs = await cm.enter_async_context(
+                self.scheduler.slot(stage, build, make=make),
+            )
+            if make:
+                kwargs.update(make_jobs.make_kwargs(kwargs.get('env')))
             if isinstance(stdout, Path):
                 stdout_path = stdout
                 stdout = cm.enter_context(stdout.open('wb'))
@@ -76,26 +338,68 @@ class Root:
                 else:
                     stderr = cm.enter_context(stderr.open('wb'))
             print('starting:', args)
-            proc = await asyncio.create_subprocess_exec(
-                *args,
-                **kwargs,
-                stdout=stdout,
-                stderr=stderr,
-            )
-        stdout_data, stderr_data = await proc.communicate(input)
-        print('done    :', args)
-        if check and proc.returncode != 0:
+            with self.tracer.span(
+                'process', _describe_args(args),
+                stage=stage,
+                build=None if build is None else build.tag,
+                case=None if case is None else case.name,
+                detail=shlex.join(str(arg) for arg in args),
+            ) as span:
+                proc = await process.run(
+                    args,
+                    **kwargs,
+                    input=input,
+                    stdout=stdout,
+                    stderr=stderr,
+                    timeout=timeout,
+                )
+                span.returncode = proc.returncode
+                span.set_rusage(proc.rusage, proc.max_rss)
+            self.memory_gate.observe(stage, proc.max_rss)
+            print('done    :', args)
+        if proc.timed_out:
+            exc = ProcessTimeout(f'process {args} timed out after {timeout}s')
+        elif check and proc.returncode != 0:
             exc = AssertionError(f'process {args} returned {proc.returncode}')
+        else:
+            exc = None
+        if exc is not None:
             if stdout_path:
                 exc.add_note(f'stdout: {stdout_path}')
             if stderr_path:
                 exc.add_note(f'stderr: {stderr_path}')
             raise exc
-        return types.SimpleNamespace(
-            stdout_data=stdout_data,
-            stderr_data=stderr_data,
-            returncode=proc.returncode,
-        )
+        return proc
+
+    def get_timeout(self, stage, case=None):
+        """Get the timeout for a stage in seconds, or None
+
+        A case can override the global timeouts (see Case.timeouts).
+        """
+        if case is not None and stage in case.timeouts:
+            return case.timeouts[stage]
+        return self.timeouts.get(stage)
 
     async def get_feature(self, tag):
         return _FEATURES[tag]
+
+
+def _describe_args(args):
+    """Short name of a command, for traces"""
+    words = [os.path.basename(str(args[0]))]
+    for arg in args[1:]:
+        # The first argument that looks like a subcommand (e.g. of git)
+        arg = str(arg)
+        if not arg.startswith('-') and '/' not in arg and '=' not in arg:
+            words.append(arg)
+            break
+    return ' '.join(words)
+
+
+def _get_exec_rlimits(memory_limit, cpu_limit):
+    rlimits = {}
+    if memory_limit:
+        rlimits['RLIMIT_AS'] = memory_limit
+    if cpu_limit:
+        rlimits['RLIMIT_CPU'] = cpu_limit
+    return rlimits
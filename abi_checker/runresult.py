@@ -9,9 +9,17 @@ class RunResult(enum.Enum):
     EXPECTED_FAILURE = 'expected failure', '➖'
     UNEXPECTED_SUCCESS = 'unexpected success', '🎆'
     ERROR = 'error', '💥'
+    TIMEOUT = 'timeout', '⏰'
 
     def __new__(cls, value, emoji):
         self = object.__new__(cls)
         self._value_ = value
         self.emoji = emoji
         return self
+
+
+class Expectation(enum.Enum):
+    """What expected.py (and the limited API version) predict for a cell"""
+    WORKS = 'expected to work'
+    FAILS = 'expected to fail'
+    SKIPPED = 'skipped'
@@ -0,0 +1,204 @@
+import collections
+import contextlib
+import asyncio
+
+from .jobserver import JobPipe
+
+# When CPUs are scarce, waiting processes start in this order (lowest
+# first): quick housekeeping (git etc.) that everything else waits for,
+# then work that completes results, then the long CPython builds.
+STAGE_CLASSES = {
+    'other': 0,
+    'exec': 1,
+    'compile': 2,
+    'make': 3,
+    'configure': 3,
+}
+
+
+class Scheduler:
+    """Decides which waiting process gets the next jobserver token
+
+    Builds are started in the order given to `rank_builds()`: the report
+    puts first the builds that unblock the most result cells.
+    Within a stage class, processes for higher-ranked builds go first.
+
+    Processes for builds that are boosted (ones that someone is waiting
+    for; see `boosting()`) go before all others.
+
+    Before getting a token, a process waits until there's enough memory
+    for it (see MemoryGate), so tokens aren't held by processes that
+    can't run yet.
+    """
+
+    def __init__(self, jobserver, memory_gate=None):
+        self.jobserver = jobserver
+        self.memory_gate = memory_gate
+        self.build_ranks = {}
+        self.boosted = collections.Counter()
+        self.queued = collections.Counter()
+        self.running = collections.Counter()
+
+    def rank_builds(self, builds):
+        self.build_ranks = {build.tag: i for i, build in enumerate(builds)}
+
+    @contextlib.contextmanager
+    def boosting(self, *builds):
+        """Boost the given builds while the body runs
+
+        Boosts are counted: a build stays boosted until all requests
+        that boosted it are done.
+        """
+        tags = {build.tag for build in builds}
+        new = [tag for tag in tags if not self.boosted[tag]]
+        self.boosted.update(tags)
+        if new:
+            self.jobserver.reprioritize()
+        try:
+            yield
+        finally:
+            self.boosted.subtract(tags)
+            ended = [tag for tag in tags if not self.boosted[tag]]
+            for tag in ended:
+                del self.boosted[tag]
+            if ended:
+                self.jobserver.reprioritize()
+
+    def priority(self, stage, build=None):
+        if build is None:
+            boost = 0
+            rank = 0
+        else:
+            boost = 0 if build.tag in self.boosted else 1
+            rank = self.build_ranks.get(build.tag, len(self.build_ranks))
+        return boost, STAGE_CLASSES[stage], rank
+
+    @contextlib.asynccontextmanager
+    async def slot(self, stage='other', build=None, *, make=False):
+        """Hold memory and a jobserver token for a process of the given
+        stage & build
+
+        With make=True, yields MakeJobs for the make's parallel jobs.
+        """
+        self.queued[stage] += 1
+        queued = True
+        priority = lambda: self.priority(stage, build)
+        try:
+            async with contextlib.AsyncExitStack() as cm:
+                await cm.enter_async_context(
+                    self._job_slot(stage, build, priority),
+                )
+                if make:
+                    make_jobs = await cm.enter_async_context(
+                        MakeJobs(self, stage, build, priority),
+                    )
+                else:
+                    make_jobs = None
+                self.queued[stage] -= 1
+                queued = False
+                self.running[stage] += 1
+                try:
+                    yield make_jobs
+                finally:
+                    self.running[stage] -= 1
+        finally:
+            if queued:
+                self.queued[stage] -= 1
+
+    @contextlib.asynccontextmanager
+    async def _job_slot(self, stage, build, priority):
+        """Hold a memory reservation, then a token"""
+        async with contextlib.AsyncExitStack() as cm:
+            if self.memory_gate is not None:
+                await cm.enter_async_context(
+                    self.memory_gate.reservation(
+                        stage, build, priority=priority,
+                    ),
+                )
+            token = await cm.enter_async_context(
+                self.jobserver.token(priority=priority),
+            )
+            yield token
+
+    def format_queue_depths(self):
+        parts = [
+            f'{stage}:{self.running[stage]}+{self.queued[stage]}'
+            for stage in STAGE_CLASSES
+            if self.running[stage] or self.queued[stage]
+        ]
+        if self.memory_gate is not None:
+            parts.append(self.memory_gate.format_usage())
+        return ' '.join(parts)
+
+
+class MakeJobs:
+    """Job slots lent to a running make
+
+    The make gets a JobPipe of its own (see `make_kwargs()`). Its first
+    job runs on the slot of the make process itself; for each additional
+    job it takes a token from its pipe, and puts it back when the job is
+    done. Each token we put there is a slot from the Scheduler: a memory
+    reservation (for one job of the stage) and a jobserver token.
+
+    make doesn't say when it wants a token, so its pipe is checked every
+    POLL_INTERVAL seconds: when it's empty, another slot is requested
+    (so at most one lent slot waits unused); tokens that make gave back
+    beyond that one are returned.
+    """
+
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, scheduler, stage, build, priority):
+        self.scheduler = scheduler
+        self.stage = stage
+        self.build = build
+        self.priority = priority
+        self.max_jobs = scheduler.jobserver.jobs
+        self._pipe = None
+        self._lent = []  # AsyncExitStacks holding slots
+        self._task = None
+
+    def make_kwargs(self, env=None):
+        """Extra arguments for subprocess.Popen() to run make"""
+        return self._pipe.make_kwargs(self.max_jobs, env)
+
+    async def __aenter__(self):
+        self._pipe = JobPipe()
+        self._task = asyncio.create_task(
+            self._lend(), name=f'make jobs of {self.build}',
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        # make has exited: the tokens it held are gone with it
+        while self._lent:
+            await self._lent.pop().aclose()
+        self._pipe.close()
+
+    async def _lend(self):
+        while True:
+            available = self._pipe.count()
+            if available > 1:
+                try:
+                    self._pipe.take()
+                except BlockingIOError:
+                    # make took them in the meantime
+                    continue
+                await self._lent.pop().aclose()
+                continue
+            if not available and len(self._lent) < self.max_jobs - 1:
+                async with contextlib.AsyncExitStack() as cm:
+                    token = await cm.enter_async_context(
+                        self.scheduler._job_slot(
+                            self.stage, self.build, self.priority,
+                        ),
+                    )
+                    self._pipe.put(token)
+                    self._lent.append(cm.pop_all())
+                continue
+            await asyncio.sleep(self.POLL_INTERVAL)
@@ -29,12 +29,22 @@ socket.onclose = function (event) {
     }
 }
 
+// Only ask for results that are on screen; the server computes
+// these first (and possibly nothing else).
+const observer = new IntersectionObserver(function (entries) {
+    for (const entry of entries) {
+        if (entry.isIntersecting) {
+            observer.unobserve(entry.target);
+            socket.send(entry.target.getAttribute('data-run'));
+        }
+    }
+});
+
 socket.onopen = function (event) {
     class UpdatingSpinner extends HTMLElement {
         connectedCallback() {
             this.classList.add('spinning');
-            const data_run = this.getAttribute('data-run');
-            socket.send(data_run);
+            observer.observe(this);
         }
     }
 
@@ -1,13 +1,13 @@
 from functools import cached_property
 import dataclasses
-import tempfile
-import asyncio
+import hashlib
 
 from .case import Case
-from .util import cached_task
+from .util import cached_task, link_file
 from .build import Build
 from .runresult import RunResult
 from .compileoptions import CompileOptions
+from .elf import get_dynamic_symbols
 
 
 @dataclasses.dataclass
@@ -18,8 +18,8 @@ class TestModule:
 
     @cached_task
     async def get_result(self):
-        proc = await self.compile()
-        if proc.returncode != 0:
+        returncode = await self.compile()
+        if returncode != 0:
             return RunResult.BUILD_FAILURE
         return RunResult.SUCCESS
 
@@ -27,6 +27,14 @@ class TestModule:
     def root(self):
         return self.case.root
 
+    @cached_property
+    def tag(self):
+        return '/'.join((
+            self.case.tag,
+            self.compile_build.tag,
+            self.compile_options.tag,
+        ))
+
     @cached_property
     def path(self):
         return (
@@ -52,29 +60,70 @@ class TestModule:
         flags.append(f'-I{self.case.path}')
         return flags
 
+    @cached_task
+    async def get_artifact_key(self):
+        """Digest of the compiler, its flags and the case sources"""
+        hasher = hashlib.sha256()
+        for part in (
+            await self.compile_build.get_compiler(),
+            *(await self.get_flags()),
+            self.case.digest,
+        ):
+            hasher.update(str(part).encode() + b'\0')
+        return hasher.hexdigest()
+
+    @cached_task
+    async def get_extension_digest(self):
+        """Digest of the compiled extension's contents"""
+        with open(self.extension_module_path, 'rb') as f:
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+
+    @cached_task
+    async def get_imported_symbols(self):
+        """Names of dynamic symbols the extension needs; None if unknown"""
+        if await self.get_result() != RunResult.SUCCESS:
+            return None
+        symbols = get_dynamic_symbols(self.extension_module_path)
+        if symbols is None:
+            return None
+        return symbols.undefined
+
     async def compile(self):
-        build = self.compile_build
-        cc = await build.get_compiler()
-        flags = await self.get_flags()
-        self.extension_module_path.unlink(missing_ok=True)
-        try:
-            async with self.lock:
-                with tempfile.TemporaryDirectory() as tmpdir:
-                    proc = await self.root.run_process(
-                        cc, *flags, '--shared',
-                        self.case.extension_source_path,
-                        '-o', self.extension_module_path,
-                        '-fPIC',
-                        stdout=self.path / 'compile.log',
-                        stderr=self.path / 'compile.log',
-                        cwd=tmpdir,
-                        check=False,
-                    )
-        except:
-            self.extension_module_path.unlink(missing_ok=True)
-            raise
-        return proc
+        """Compile the extension (or reuse a cached build); return returncode
+        """
+        entry, returncode = await self.root.module_cache.get(
+            await self.get_artifact_key(), self._compile,
+        )
+        self.path.mkdir(parents=True, exist_ok=True)
+        link_file(entry / 'extension.so', self.path / 'extension.so')
+        if self.root.pack_logs:
+            await self.root.log_store.put_file(
+                self.compile_build.tag, self.tag, 'compile.log',
+                entry / 'compile.log',
+            )
+        else:
+            link_file(entry / 'compile.log', self.path / 'compile.log')
+        return returncode
 
-    @cached_property
-    def lock(self):
-        return asyncio.Lock()
+    def get_log(self, name):
+        """Get the contents of a log (compile.log), or None"""
+        return self.root.log_store.get(self.compile_build.tag, self.tag, name)
+
+    async def _compile(self, tmpdir):
+        proc = await self.root.run_process(
+            await self.compile_build.get_compiler(),
+            *(await self.get_flags()),
+            '--shared',
+            self.case.extension_source_path,
+            '-o', tmpdir / 'extension.so',
+            '-fPIC',
+            stdout=tmpdir / 'compile.log',
+            stderr=tmpdir / 'compile.log',
+            cwd=tmpdir,
+            check=False,
+            stage='compile',
+            build=self.compile_build,
+            case=self.case,
+            timeout=self.root.get_timeout('compile', self.case),
+        )
+        return proc.returncode
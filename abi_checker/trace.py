@@ -0,0 +1,157 @@
+"""Timing of processes and tasks, for tuning concurrency"""
+
+import dataclasses
+import collections
+import contextlib
+import heapq
+import json
+import time
+import os
+
+# Spans the web app keeps for its trace download
+RECENT_SPANS = 10000
+
+
+@dataclasses.dataclass
+class Span:
+    kind: str  # 'process' or 'task'
+    name: str
+    stage: str = None
+    build: str = None
+    case: str = None
+    detail: str = None
+    start: float = None
+    end: float = None
+    returncode: int = None
+    cpu_time: float = None
+    max_rss: int = None
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def set_rusage(self, rusage, max_rss):
+        """Record a process's resource usage (see process.run)"""
+        self.cpu_time = rusage.ru_utime + rusage.ru_stime
+        self.max_rss = max_rss
+
+
+class Tracer:
+    """Records Spans; see Root.run_process and cached_task
+
+    Totals (see summarize) cover all spans, but only the last `max_spans`
+    spans are kept for chrome_trace (all of them if max_spans is None).
+    """
+
+    def __init__(self, max_spans=None):
+        self.spans = collections.deque(maxlen=max_spans)
+        self.origin = time.monotonic()
+        self._totals = {}
+
+    @contextlib.contextmanager
+    def span(self, kind, name, **attrs):
+        span = Span(kind, name, **attrs, start=time.monotonic())
+        try:
+            yield span
+        finally:
+            span.end = time.monotonic()
+            self._add_to_totals(span)
+            self.spans.append(span)
+
+    def _add_to_totals(self, span):
+        if span.kind == 'process':
+            key = span.kind, span.stage
+        else:
+            key = span.kind, f'{span.name}()'
+        totals = self._totals.setdefault(key, {
+            'kind': key[0],
+            'name': key[1],
+            'count': 0,
+            'wall_time': 0,
+            'max_wall_time': 0,
+            'cpu_time': 0,
+            'max_rss': 0,
+        })
+        totals['count'] += 1
+        totals['wall_time'] += span.duration
+        totals['max_wall_time'] = max(totals['max_wall_time'], span.duration)
+        totals['cpu_time'] += span.cpu_time or 0
+        totals['max_rss'] = max(totals['max_rss'], span.max_rss or 0)
+
+    def summarize(self):
+        """Get totals for processes by stage, then for tasks by name
+
+        Returns a list of dicts with keys: kind, name, count, wall_time,
+        max_wall_time, cpu_time, max_rss. (Tasks have no CPU time or RSS
+        of their own.)
+        """
+        return [
+            dict(totals)
+            for key, totals in sorted(self._totals.items())
+        ]
+
+    def format_summary(self):
+        lines = [
+            f'{"stage/task":<30}{"count":>7}{"wall s":>10}{"max s":>9}'
+            + f'{"CPU s":>10}{"max RSS":>10}'
+        ]
+        for row in self.summarize():
+            line = (
+                f'{row["name"]:<30}{row["count"]:>7}'
+                + f'{row["wall_time"]:>10.1f}{row["max_wall_time"]:>9.1f}'
+            )
+            if row['kind'] == 'process':
+                line += (
+                    f'{row["cpu_time"]:>10.1f}'
+                    + f'{row["max_rss"] / 2**20:>8.0f}MB'
+                )
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        """Get the spans in Chrome's Trace Event format (for Perfetto etc.)
+
+        Processes and tasks are shown as two "processes", with overlapping
+        spans spread over as many "threads" as needed.
+        """
+        events = []
+        for pid, kind in enumerate(('process', 'task'), start=1):
+            events.append({
+                'ph': 'M', 'name': 'process_name', 'pid': pid,
+                'args': {'name': f'{kind}es' if kind == 'process' else 'tasks'},
+            })
+            spans = sorted(
+                (s for s in self.spans if s.kind == kind),
+                key=lambda s: s.start,
+            )
+            # Assign each span to the first free lane (tid)
+            free_at = []  # heap of (end, tid)
+            for span in spans:
+                if free_at and free_at[0][0] <= span.start:
+                    end, tid = heapq.heappop(free_at)
+                else:
+                    tid = len(free_at) + 1
+                heapq.heappush(free_at, (span.end, tid))
+                events.append({
+                    'ph': 'X',
+                    'name': span.name,
+                    'cat': span.stage or kind,
+                    'pid': pid,
+                    'tid': tid,
+                    'ts': (span.start - self.origin) * 1e6,
+                    'dur': span.duration * 1e6,
+                    'args': {
+                        key: value
+                        for key in (
+                            'stage', 'build', 'case', 'detail',
+                            'returncode', 'cpu_time', 'max_rss',
+                        )
+                        if (value := getattr(span, key)) is not None
+                    },
+                })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, path):
+        tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+        tmp.write_text(json.dumps(self.chrome_trace()))
+        os.replace(tmp, path)
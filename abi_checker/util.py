@@ -1,8 +1,16 @@
+import resource
 import asyncio
+import signal
+import re
+import os
 
 
 class cached_task:
-    """Like cached_property, but async"""
+    """Like cached_property, but async
+
+    If the instance has a Tracer (as `tracer`, or `root.tracer`),
+    the task's run is recorded there.
+    """
     def __init__(self, func):
         self.func = func
         self.attrname = None
@@ -20,8 +28,14 @@ class cached_task:
         try:
             return cache[self.attrname]
         except KeyError:
+            coro = self.func(instance)
+            tracer = getattr(instance, 'tracer', None)
+            if tracer is None:
+                tracer = getattr(getattr(instance, 'root', None), 'tracer', None)
+            if tracer is not None:
+                coro = _traced(tracer, self.attrname, instance, coro)
             task = asyncio.create_task(
-                self.func(instance),
+                coro,
                 name=f'{self.attrname}() of {instance!r}',
             )
         async def get_task():
@@ -29,3 +43,100 @@ class cached_task:
         get_task.task = task
         cache[self.attrname] = get_task
         return get_task
+
+    def is_done(self, instance):
+        """True if the task was started and has finished
+
+        Unlike attribute access, this doesn't start the task.
+        """
+        try:
+            get_task = instance.__dict__[self.attrname]
+        except KeyError:
+            return False
+        return get_task.task.done()
+
+    def invalidate(self, instance):
+        """Forget the cached task, so the next access starts a new one
+
+        A task that's still running isn't cancelled; whoever is already
+        awaiting it gets its result. Returns that task, or None.
+        """
+        get_task = instance.__dict__.pop(self.attrname, None)
+        if get_task is None:
+            return None
+        return get_task.task
+
+
+async def _traced(tracer, name, instance, coro):
+    with tracer.span('task', name, detail=str(instance)):
+        return await coro
+
+
+def kill_process_group(pid):
+    """Kill a process started with start_new_session, and its children"""
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def set_rlimits(rlimits):
+    """Lower soft limits; rlimits maps names like 'RLIMIT_AS' to values
+
+    Meant for preexec_fn.
+    """
+    for name, value in rlimits.items():
+        res = getattr(resource, name)
+        soft, hard = resource.getrlimit(res)
+        resource.setrlimit(res, (value, hard))
+
+
+_SIZE_SUFFIXES = {'': 1, 'k': 2**10, 'm': 2**20, 'g': 2**30, 't': 2**40}
+
+def parse_size(text):
+    """Parse a size in bytes, like '512M' or '2G'"""
+    match = re.fullmatch(
+        r'\s*(\d+(?:\.\d*)?)\s*([kmgt]?)i?b?\s*', text.lower(),
+    )
+    if not match:
+        raise ValueError(f'invalid size: {text!r}')
+    return int(float(match[1]) * _SIZE_SUFFIXES[match[2]])
+
+
+def parse_timeouts(text):
+    """Parse 'STAGE=SECONDS[,STAGE=SECONDS...]' into a dict"""
+    timeouts = {}
+    for item in text.split(','):
+        if item.strip():
+            stage, sep, seconds = item.partition('=')
+            if not sep:
+                raise ValueError(f'expected STAGE=SECONDS: {item!r}')
+            timeouts[stage.strip()] = float(seconds)
+    return timeouts
+
+
+def touch(path):
+    """Mark a cache entry as used now (see cachegc)"""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def link_file(src, dst):
+    """Make dst a hard link to src, atomically
+
+    If src doesn't exist, remove dst.
+    """
+    try:
+        if os.path.samefile(src, dst):
+            return
+    except FileNotFoundError:
+        pass
+    tmp = dst.with_name(f'.{dst.name}.{os.getpid()}.tmp')
+    try:
+        os.link(src, tmp)
+    except FileNotFoundError:
+        dst.unlink(missing_ok=True)
+        return
+    os.replace(tmp, dst)
@@ -0,0 +1,173 @@
+"""Prefork exec server, run with an exec build's interpreter
+
+Reads JSON requests, one per line, from stdin. For each, forks a child
+that runs a script like `python script.py` would, and writes JSON lines
+with the child's pid and, once it exits, its return code and resource
+usage (CPU seconds, peak RSS in bytes or null if it's no higher than
+what the child inherited) to stdout.
+Each child starts a new session, so it can be killed with its children
+using os.killpg(pid, ...).
+
+This runs on every Python version we test (3.5+); keep it compatible.
+"""
+
+import traceback
+import resource
+import select
+import signal
+import runpy
+import json
+import sys
+import os
+
+
+def main():
+    proto_out = os.dup(1)
+    # Stray output from the server itself shouldn't corrupt the protocol
+    os.dup2(2, 1)
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_r, False)
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    server_fds = [0, proto_out, wakeup_r, wakeup_w]
+
+    children = {}
+    buf = b''
+    eof = False
+    while not eof or children:
+        fds = [wakeup_r] if eof else [0, wakeup_r]
+        readable, _, _ = select.select(fds, [], [])
+        if wakeup_r in readable:
+            try:
+                os.read(wakeup_r, 4096)
+            except BlockingIOError:
+                pass
+        reap(children, proto_out)
+        if 0 in readable:
+            data = os.read(0, 65536)
+            if not data:
+                eof = True
+            buf += data
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                request = json.loads(line.decode())
+                # The child's ru_maxrss starts at our peak
+                inherited_rss = resource.getrusage(
+                    resource.RUSAGE_SELF,
+                ).ru_maxrss
+                pid = os.fork()
+                if pid == 0:
+                    run_child(request, server_fds)
+                children[pid] = request['id'], inherited_rss
+                send(proto_out, {'id': request['id'], 'pid': pid})
+
+
+def send(fd, message):
+    data = (json.dumps(message) + '\n').encode()
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def reap(children, proto_out):
+    while children:
+        try:
+            pid, status, rusage = os.wait4(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+        try:
+            request_id, inherited_rss = children.pop(pid)
+        except KeyError:
+            continue
+        if os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+        send(proto_out, {
+            'id': request_id,
+            'returncode': returncode,
+            'cpu_time': rusage.ru_utime + rusage.ru_stime,
+            'max_rss': (
+                rusage.ru_maxrss * 1024
+                if rusage.ru_maxrss > inherited_rss else None
+            ),
+        })
+
+
+def run_child(request, server_fds):
+    try:
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for fd in server_fds:
+            os.close(fd)
+        os.setsid()
+        for name, value in request.get('rlimits', {}).items():
+            res = getattr(resource, name)
+            soft, hard = resource.getrlimit(res)
+            resource.setrlimit(res, (value, hard))
+        os.chdir(request['cwd'])
+
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.close(devnull)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        out = os.open(request['stdout'], flags, 0o666)
+        if request['stderr'] == request['stdout']:
+            err = os.dup(out)
+        else:
+            err = os.open(request['stderr'], flags, 0o666)
+        os.dup2(out, 1)
+        os.dup2(err, 2)
+        os.close(out)
+        os.close(err)
+
+        env = request['env']
+        os.environ.clear()
+        os.environ.update(env)
+        script = request['script']
+        sys.argv = [script]
+        sys.path[0:1] = [os.path.dirname(script)] + [
+            p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p
+        ]
+    except BaseException:
+        traceback.print_exc()
+        os._exit(255)
+
+    returncode = 0
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        returncode = exit_code(e.code)
+    except BaseException:
+        # Hide the server's own frames from the traceback
+        exc_type, exc, tb = sys.exc_info()
+        while tb is not None and tb.tb_frame.f_code.co_filename != script:
+            tb = tb.tb_next
+        sys.excepthook(exc_type, exc.with_traceback(tb), tb)
+        returncode = 1
+    try:
+        if 'threading' in sys.modules:
+            sys.modules['threading']._shutdown()
+        import atexit
+        atexit._run_exitfuncs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    except BaseException:
+        traceback.print_exc()
+        returncode = returncode or 120
+    os._exit(returncode)
+
+
+def exit_code(code):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+if __name__ == '__main__':
+    main()